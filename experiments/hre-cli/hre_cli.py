@@ -1,69 +1,67 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 __author__ = "Ali Kheradmand"
 __email__ =  "kheradm2@illinois.edu"
 
 
+import os
 import argparse
 import sys
 import random
 import logging
-sys.path.append('../../src/')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../src/'))
 from anime.framework.clustering import *
 from anime.framework.hregex import *
 from anime.framework.ip_labeling import *
 from anime.framework.labeling import *
+from anime.common.flows import *
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--labeling', '-l', help='path to labeling json file', type=str, default="labeling.json")
+parser.add_argument('--labeling', '-l', help='path to labeling json file (hierarchy text file of the C++ code for '
+                                             'the prefix_src_dst and range_src_dst formats)', type=str,
+                    default="labeling.json")
 parser.add_argument('--clusters', '-c', help='number of cluster', type=int, default=1)
 parser.add_argument('--ip', help='paths with ip', type=bool, default=False)
+parser.add_argument('--format', '-f', help='format of the flows on stdin', choices=["paths", "prefix_src_dst",
+                    "range_src_dst"], default="paths")
 parser.add_argument('--batch', '-b', help='batch size', type=int, default=0)
 parser.add_argument("--seed", '-s', help='random seed', type=int, default=10)
 parsed_args = parser.parse_args()
 
 random.seed(parsed_args.seed)
 
-print ">clusters", parsed_args.clusters
-print ">batch", parsed_args.batch
+print(">clusters", parsed_args.clusters)
+print(">batch", parsed_args.batch)
 
-flows = []
+if parsed_args.format == "paths":
+    # flows are read and interned line by line
+    flows = path_store(parsed_args.ip).extend(read_path_lines(sys.stdin, parsed_args.ip))
 
-d = 0
-for l in sys.stdin:
-    path = l.strip().split()
-    if len(path) == 0:
-        continue
-    if parsed_args.ip:
-        ip = path[0]
-        path = path[1:]
-        flows.append([IPv4Prefix(ip), HRegex(path)])
-    else:
-        flows.append([HRegex(path)])
-
-    d = max(d, len(path))
-
-print "d is", d
+    d = max([len(p) for p in flows.column_labels("path")] or [0])
+    print("d is", d)
 
-device_labeling = HierarchicalLabeling.load_from_file(parsed_args.labeling)
-pathFeature = Feature("path", HRegexLabeling(device_labeling, d))
-ipFeature = Feature("dst ip", IPv4PrefixLabeling())
+    device_labeling = HierarchicalLabeling.load_from_file(parsed_args.labeling)
+    pathFeature = Feature("path", HRegexLabeling(device_labeling, d))
+    ipFeature = Feature("dst ip", IPv4PrefixLabeling())
 
-if parsed_args.ip:
-    flow_labeling = TupleLabeling([ipFeature, pathFeature])
+    if parsed_args.ip:
+        flow_labeling = TupleLabeling([ipFeature, pathFeature])
+    else:
+        flow_labeling = TupleLabeling([pathFeature])
 else:
-    flow_labeling = TupleLabeling([pathFeature])
+    with open(parsed_args.labeling) as f:
+        label_info, label_names = read_cpp_hierarchy(f)
+    device_labeling = HierarchicalLabeling(label_info)
+    flows = cpp_flow_store().extend(read_cpp_flows(sys.stdin, label_names, parsed_args.format == "range_src_dst"))
+    flow_labeling = TupleLabeling([Feature("dst ip", IPv4PrefixLabeling()), Feature("src", device_labeling),
+                                   Feature("dst", device_labeling)])
+
+print("flows", len(flows))
 
 clustering = HierarchicalClustering(parsed_args.clusters, parsed_args.batch)
 clusters = clustering.cluster(flows, Feature('flow', flow_labeling))
 
-print "final clusters:"
+print("final clusters:")
 for c in clusters:
-    print c
-
-
-
-
-
-
+    print(c)
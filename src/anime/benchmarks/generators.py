@@ -0,0 +1,116 @@
+__author__ = "Ali Kheradmand"
+__email__ =  "kheradm2@illinois.edu"
+
+"""
+    Seeded synthetic workloads for benchmarks
+"""
+
+import random
+
+from anime.framework.labeling import *
+from anime.framework.ip_labeling import *
+from anime.framework.hregex import *
+
+
+def ipv4_prefixes(n, mode="random", seed=0):
+    """
+        n distinct IPv4 prefixes
+        random: uniformly random /32s
+        clustered: /32s around a few random /16s
+        real: aligned prefixes with a routing-table-like length distribution (mostly /24s)
+    """
+    r = random.Random(seed)
+    centers = [r.getrandbits(16) << 16 for i in range(max(1, n // 500))]
+    lengths = [24] * 60 + [23, 22, 21, 20] * 5 + [16, 17, 18, 19] * 3 + [28, 30, 32] * 2
+
+    prefixes = set()
+    while len(prefixes) < n:
+        if mode == "random":
+            prefixlen, ip = 32, r.getrandbits(32)
+        elif mode == "clustered":
+            prefixlen, ip = 32, r.choice(centers) | r.getrandbits(16)
+        elif mode == "real":
+            prefixlen = r.choice(lengths)
+            ip = (r.choice(centers) | r.getrandbits(16)) >> (32 - prefixlen) << (32 - prefixlen)
+        else:
+            raise ValueError("unknown mode %s" % mode)
+        prefixes.add((ip, prefixlen))
+
+    return [IPv4Prefix("%s/%d" % (netaddr.IPAddress(ip), prefixlen)) for ip, prefixlen in sorted(prefixes)]
+
+
+def device_dag(depth=3, fanout=4, extra_parent_prob=0.0, seed=0):
+    """
+        label info (as loaded by HierarchicalLabeling) of a rooted hierarchy of devices: "Any" at the top,
+        fanout children per node and depth levels below the top; leaves are devices.
+        With extra_parent_prob, a node also gets a random second parent from the level above (making it a DAG).
+        The cost of each label is the number of devices under it.
+    """
+    r = random.Random(seed)
+    label_info = {"Any": {"parents": []}}
+    levels = [["Any"]]
+    for d in range(depth):
+        level = []
+        for p in levels[-1]:
+            for i in range(fanout):
+                l = "%s.%d" % (p, i) if p != "Any" else "g%d" % i
+                parents = [p]
+                if len(levels[-1]) > 1 and r.random() < extra_parent_prob:
+                    other = r.choice(levels[-1])
+                    if other != p:
+                        parents.append(other)
+                label_info[l] = {"parents": parents}
+                level.append(l)
+        levels.append(level)
+
+    devices = {l: set([l]) for l in levels[-1]}
+    for level in reversed(levels[:-1]):
+        for l in level:
+            devices[l] = set()
+    for level in reversed(levels[1:]):
+        for l in level:
+            for p in label_info[l]["parents"]:
+                devices[p] |= devices[l]
+    for l, info in label_info.items():
+        info["cost"] = len(devices[l])
+
+    return label_info
+
+
+def hre_paths(label_info, n, max_length=5, seed=0):
+    # n random paths (as HRegex) over the devices (leaves) of label_info
+    r = random.Random(seed)
+    has_children = set(p for info in label_info.values() for p in info["parents"])
+    devices = sorted(l for l in label_info if l not in has_children)
+    return [HRegex([r.choice(devices) for i in range(r.randint(2, max_length))]) for j in range(n)]
+
+
+def tuple_flows(n, features=("ip", "proto", "path"), ip_mode="clustered", depth=3, fanout=4, max_length=4, seed=0):
+    """
+        n flows as tuples of the given features, and the flow feature (TupleLabeling) to cluster them with
+        ip: dst IPv4 prefix, proto: DValue out of 8 protocols, path: HRE path over a device hierarchy,
+        device: a single device of the hierarchy
+    """
+    r = random.Random(seed)
+    columns = []
+    flow_features = []
+    label_info = device_dag(depth, fanout, seed=seed)
+    device_labeling = HierarchicalLabeling(label_info)
+    for f in features:
+        if f == "ip":
+            prefixes = ipv4_prefixes(max(1, n // 2), ip_mode, seed)
+            columns.append([r.choice(prefixes) for i in range(n)])
+            flow_features.append(Feature("dst ip", IPv4PrefixLabeling()))
+        elif f == "proto":
+            columns.append([r.choice(["tcp", "udp", "icmp", "gre", "esp", "ah", "sctp", "igmp"]) for i in range(n)])
+            flow_features.append(Feature("proto", DValueLabeling(8)))
+        elif f == "path":
+            columns.append(hre_paths(label_info, n, max_length, seed))
+            flow_features.append(Feature("path", HRegexLabeling(device_labeling, max_length)))
+        elif f == "device":
+            columns.append([h.regex[0].label for h in hre_paths(label_info, n, 2, seed)])
+            flow_features.append(Feature("device", device_labeling))
+        else:
+            raise ValueError("unknown feature %s" % f)
+
+    return list(zip(*columns)), Feature("flow", TupleLabeling(flow_features))
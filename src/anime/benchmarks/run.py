@@ -0,0 +1,224 @@
+__author__ = "Ali Kheradmand"
+__email__ =  "kheradm2@illinois.edu"
+
+"""
+    Micro (labelings, index, lattice) and macro (clustering engines) benchmarks, reported as JSON:
+        python -m anime.benchmarks.run --sizes 1000,10000 --output results.json
+"""
+
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import resource
+import tracemalloc
+import multiprocessing
+
+from anime.framework.labeling import *
+from anime.framework.ip_labeling import *
+from anime.framework.hregex import *
+from anime.framework.index import RTreeIndex
+from anime.framework.lattice import MeetSemiLattice
+from anime.framework.clustering import HierarchicalClustering, HierarchicalClusteringWithIndex
+from anime.framework.metrics import Metrics
+
+from .generators import *
+
+
+# micro benchmarks run in the same process, so their memory is traced (which slows allocations down) unless disabled
+trace_memory = True
+
+
+def peak_rss_kb():
+    # high-water mark of the whole process: only meaningful for a process that runs a single benchmark
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def timed(name, ops, f, labeling=None, **info):
+    # calls of the labeling itself (not of the labelings it is made of) are reported, and with trace_memory the
+    # peak of the memory allocated while f runs (on top of what was allocated before)
+    metrics = Metrics()
+    if labeling is not None:
+        metrics.instrument(labeling, "labeling")
+    if trace_memory:
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    f()
+    elapsed = time.perf_counter() - start
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+    metrics.uninstrument()
+
+    res = {"name": name, "ops": ops, "seconds": elapsed, "ops_per_sec": ops / elapsed if elapsed > 0 else None}
+    if trace_memory:
+        res["peak_alloc_kb"] = peak // 1024
+    if labeling is not None:
+        res["join_calls"] = metrics.counts["labeling.join"]
+        res["join_cost_calls"] = metrics.counts["labeling.join_cost"]
+    res.update(info)
+    logging.info("%s: %d ops in %.3f s", name, ops, elapsed)
+    return res
+
+
+def labeling_workloads(n, seed):
+    label_info = device_dag(depth=3, fanout=4, extra_parent_prob=0.1, seed=seed)
+    devices = HierarchicalLabeling(label_info)
+    res = []
+    for mode in ["random", "clustered", "real"]:
+        res.append(("ipv4/" + mode, IPv4PrefixLabeling(), ipv4_prefixes(n, mode, seed)))
+    res.append(("hierarchical", devices, sorted(label_info)))
+    res.append(("dvalue", DValueLabeling(8), ["v%d" % i for i in range(8)]))
+    res.append(("hre", HRegexLabeling(devices, 4), hre_paths(label_info, n, 4, seed)))
+    flows, feature = tuple_flows(n, ("ip", "proto", "device"), seed=seed)
+    res.append(("tuple", feature.labeling, flows))
+    return res
+
+
+def micro_labelings(n, pairs, seed):
+    results = []
+    for name, labeling, labels in labeling_workloads(n, seed):
+        r = random.Random(seed)
+        sample = [(r.choice(labels), r.choice(labels)) for i in range(pairs)]
+        # HRE joins are graph searches, orders of magnitude slower than the rest
+        if name == "hre":
+            sample = sample[:max(1, pairs // 100)]
+
+        def run(op):
+            # looked up at call time, so that the calls are counted
+            return lambda: [getattr(labeling, op)(a, b) for a, b in sample]
+
+        ops = ["join", "join_cost", "subset"]
+        if name not in ["hre"]:
+            ops.append("meet")
+        for op in ops:
+            results.append(timed("labeling/%s/%s" % (name, op), len(sample), run(op), labeling))
+
+    return results
+
+
+def micro_index(n, queries, seed):
+    results = []
+    workloads = [("ipv4/clustered", Feature("ip", IPv4PrefixLabeling()), ipv4_prefixes(n, "clustered", seed))]
+    workloads.append(("tuple",) + tuple(reversed(tuple_flows(n, ("ip", "proto", "device"), seed=seed))))
+    for name, feature, labels in workloads:
+        labeling = feature.labeling
+        specs = [Spec(labeling.cost(l), l) for l in labels]
+        index = RTreeIndex(feature)
+
+        def insert():
+            for i, s in enumerate(specs):
+                index.insert(s, i)
+        results.append(timed("index/%s/insert" % name, len(specs), insert, labeling, size=n))
+
+        r = random.Random(seed)
+        sample = [r.choice(specs) for i in range(queries)]
+        results.append(timed("index/%s/knn" % name, len(sample),
+                             lambda: [index.get_knn_approx(s, 3) for s in sample], labeling, size=n))
+
+        # queries that cover a few labels each
+        covers = []
+        for i in range(queries):
+            joined = labeling.join(r.choice(specs).value, r.choice(specs).value)
+            covers.append(Spec(joined.cost, joined.value))
+        results.append(timed("index/%s/get_subsets" % name, len(covers),
+                             lambda: [index.get_subsets(c) for c in covers], labeling, size=n))
+
+    return results
+
+
+def micro_lattice(n, seed):
+    results = []
+    workloads = [("ipv4/clustered", Feature("ip", IPv4PrefixLabeling()), ipv4_prefixes(n, "clustered", seed))]
+    label_info = device_dag(depth=3, fanout=4, seed=seed)
+    workloads.append(("hierarchical", Feature("device", HierarchicalLabeling(label_info)), sorted(label_info)))
+    for name, feature, labels in workloads:
+        def insert():
+            lattice = MeetSemiLattice(feature)
+            for l in labels:
+                lattice.insert(l)
+        results.append(timed("lattice/%s/insert" % name, len(labels), insert, feature.labeling, size=len(labels)))
+
+    return results
+
+
+# the parallel engine is left out: parallel_clustering imports ray at module level
+engines = {
+    "base": lambda args: HierarchicalClustering(cluster_count=args.cluster_count, batch_size=args.batch_size),
+    "index": lambda args: HierarchicalClusteringWithIndex(cluster_count=args.cluster_count),
+}
+
+
+def macro_clustering(job):
+    # runs in its own process, so that the reported peak RSS belongs to this run only
+    global trace_memory
+    trace_memory = False
+    engine, n, args = job
+    flows, feature = tuple_flows(n, args.features.split(","), seed=args.seed)
+    clustering = engines[engine](args)
+    clustering.metrics = Metrics()
+    res = timed("clustering/%s" % engine, n, lambda: clustering.cluster(flows, feature), None,
+                size=n, cluster_count=args.cluster_count, features=args.features)
+    res["peak_rss_kb"] = peak_rss_kb()
+    res["overall_cost"] = clustering.overall_cost
+    res["metrics"] = clustering.get_metrics()
+    res["join_calls"] = res["metrics"].get("flow.join", 0)
+    res["join_cost_calls"] = res["metrics"].get("flow.join_cost", 0)
+    return res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Anime benchmarks")
+    parser.add_argument("--suites", default="labeling,index,lattice,clustering",
+                        help="comma separated subset of labeling,index,lattice,clustering")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="flow counts of the clustering benchmarks")
+    parser.add_argument("--engines", default=",".join(sorted(engines)), help="clustering engines to run")
+    parser.add_argument("--features", default="ip,proto,device", help="flow features of the clustering benchmarks")
+    parser.add_argument("--cluster-count", type=int, default=10)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--micro-size", type=int, default=10000, help="labels per micro benchmark")
+    parser.add_argument("--micro-ops", type=int, default=10000, help="operations per micro benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-trace-memory", action="store_true",
+                        help="do not trace the memory of micro benchmarks (tracing slows them down)")
+    parser.add_argument("--output", "-o", default=None, help="output JSON file (default: stdout)")
+    parser.add_argument("--verbose", "-v", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    global trace_memory
+    trace_memory = not args.no_trace_memory
+
+    suites = args.suites.split(",")
+    results = []
+    if "labeling" in suites:
+        results += micro_labelings(args.micro_size, args.micro_ops, args.seed)
+    if "index" in suites:
+        results += micro_index(args.micro_size, min(args.micro_ops, 1000), args.seed)
+    if "lattice" in suites:
+        results += micro_lattice(min(args.micro_size, 1000), args.seed)
+    if "clustering" in suites:
+        for n in [int(s) for s in args.sizes.split(",")]:
+            for engine in args.engines.split(","):
+                with multiprocessing.Pool(1) as pool:
+                    results.append(pool.apply(macro_clustering, ((engine, n, args),)))
+
+    report = {"python": platform.python_version(), "platform": platform.platform(), "seed": args.seed,
+              "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
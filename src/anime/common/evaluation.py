@@ -6,7 +6,10 @@ __email__ =  "kheradm2@illinois.edu"
 """
 
 import os
+import json
+import math
 import time
+import hashlib
 import logging
 
 from anime.framework.labeling import *
@@ -32,7 +35,7 @@ class IncrementalAtomCoverMapGenerator(object):
     def create_lattice(self):
         filename = "/meet_semilattice.pk"
         if os.path.exists(self.args.out + filename):
-            with open(self.args.out + filename) as f:
+            with open(self.args.out + filename, 'rb') as f:
                 self.lattice = pickle.load(f)
                 return
 
@@ -50,38 +53,35 @@ class IncrementalAtomCoverMapGenerator(object):
         logging.info("finished creating lattice in %s seconds", time.time() - start_time)
         logging.info("input size was %s output size is", len(self.clusters), len(self.lattice.get_all_nodes()))
 
-        with open(self.args.out + filename, 'w') as f:
+        with open(self.args.out + filename, 'wb') as f:
             pickle.dump(self.lattice, f)
 
-    def get_accepted(self, new_intents):
-        ret = set()
-        for i in new_intents:
-            ret = ret | self.lattice.get_label_subtree(self.clusters[i].value)
-        return ret
+    def mark_covered(self, new_intents, k):
+        # nodes under the new intents that were not covered before, marked as covered at k
+        new_accepted = []
+        stack = [self.lattice.label_to_node[self.clusters[i].value] for i in new_intents]
+        while stack:
+            n = stack.pop()
+            if n in self.covered_at:
+                continue
+            self.covered_at[n] = k
+            new_accepted.append(n)
+            stack.extend(n.children)
+        return new_accepted
 
     def get_cover_map(self, intent_info):
-        # filename = "/atom_cover_map.pk"
-        # if os.path.exists(args.out + filename):
-        #     with open(args.out + filename) as f:
-        #         cover_map = pickle.load(f)
-        #     return cover_map
-
-        covered = set()
+        # the subtree of a covered node is covered too, so the walks stop at marked nodes and every node of the
+        # lattice is visited once over all the k's
+        self.covered_at = {}
         cover_map = {}
 
         for info in intent_info:
             k = info.k
             logging.info("k %s", k)
-            new_intents = info.added
-            logging.info("new_intents %s", new_intents)
-            new_accepted = self.get_accepted(new_intents) - covered
-            logging.info("new_accepted %s %s", new_accepted, len(new_accepted))
-            covered |= new_accepted
-            logging.info("covered %s", len(covered))
-            cover_map[k] = new_accepted
-
-        # with open(args.out + filename, 'w') as f:
-        #     pickle.dump(cover_map, f)
+            logging.info("new_intents %s", info.added)
+            cover_map[k] = self.mark_covered(info.added, k)
+            logging.info("new_accepted %s", len(cover_map[k]))
+            logging.info("covered %s", len(self.covered_at))
 
         return cover_map
 
@@ -96,7 +96,7 @@ class IncrementalAtomCoverMapGenerator(object):
             new_covered = sum([self.lattice.get_cardinality(n) for n in cover_map[k]])
             covered += new_covered
             res[k] = {"predicted_positive": covered}
-            logging.info(k, res[k])
+            logging.info("%s %s", k, res[k])
 
         return res
 
@@ -149,14 +149,45 @@ class IncrementalCoverMapGenerator(object):
         else:
             return self._get_new_accepted_no_index(new_intents, remaining)
 
+    def cover_map_key(self, intent_info):
+        # hash of everything the cover map depends on, so that a cached one is only reused if it is still valid
+        h = hashlib.md5()
+        h.update(labeling_signature(self.feature.name, self.feature.labeling).encode())
+        h.update(str(len(self.flows)).encode())
+        for f in self.flows:
+            h.update(str(f).encode() + b"\n")
+        for c in self.clusters:
+            h.update(str(c.value).encode() + b"\n")
+        for info in intent_info:
+            h.update(str((info.k, list(info.added), list(info.removed))).encode() + b"\n")
+        return h.hexdigest()
+
+    def load_cover_map(self, intent_info, args):
+        path = args.out + "/%s_cover_map" % self.name
+        cover_map = CoverMapFile.load(path, self.cover_map_key(intent_info))
+        if cover_map is not None:
+            logging.info("%s exists, loading it from file", path)
+        return cover_map
+
+    def store_cover_map(self, cover_map, intent_info, args):
+        writer = CoverMapFile(args.out + "/%s_cover_map" % self.name, self.cover_map_key(intent_info))
+        for info in intent_info:
+            writer.append(info.k, cover_map[info.k])
+        writer.close()
+
     def get_cover_map(self, intent_info, args):
-        filename = "/%s_cover_map.pk" % self.name
-        if os.path.exists(args.out + filename):
-            logging.info("%s exists, loading it from file", filename)
-            with open(args.out + filename) as f:
-                cover_map = pickle.load(f)
+        intent_info = list(intent_info)
+        cover_map = self.load_cover_map(intent_info, args)
+        if cover_map is not None:
             return cover_map
 
+        writer = CoverMapFile(args.out + "/%s_cover_map" % self.name, self.cover_map_key(intent_info))
+        cover_map = self.compute_cover_map(intent_info, writer)
+        writer.close()
+        return cover_map
+
+    def compute_cover_map(self, intent_info, writer=None):
+        # k -> flows first covered at k, also appended to writer (a CoverMapFile) as each k is computed
         if self.use_index:
             start_time = time.time()
             logging.info("Indexing flows")
@@ -179,12 +210,353 @@ class IncrementalCoverMapGenerator(object):
             logging.info("new_accepted %s %s", new_accepted, len(new_accepted))
             logging.info("remaining len %s", len(remaining))
             cover_map[k] = new_accepted
+            if writer is not None:
+                writer.append(k, new_accepted)
 
+        return cover_map
 
-        with open(args.out + filename, 'w') as f:
-            pickle.dump(cover_map, f)
 
-        return cover_map
+def labeling_signature(name, labeling):
+    # name, type, scalar parameters and hierarchy of a feature and of the features it is made of
+    params = sorted((a, v) for a, v in vars(labeling).items() if isinstance(v, (bool, int, float, str)))
+    res = "%s:%s%s" % (name, type(labeling).__name__, params)
+    if hasattr(labeling, "label_info"):
+        # the hierarchy decides coverage, so any change to the parents or costs of a label invalidates the key
+        res += "%s" % sorted((l, sorted(info["parents"]), info["cost"], info.get("cardinality"))
+                             for l, info in labeling.label_info.items())
+    for feature in getattr(labeling, "features", []):
+        res += "(%s)" % labeling_signature(feature.name, feature.labeling)
+    if hasattr(labeling, "labeling"):
+        res += "(%s)" % labeling_signature("labels", labeling.labeling)
+    return res
+
+
+class CoverMapFile(object):
+    """
+        Binary cover map: <path>.ids holds the flow ids (uint32) of all the k's one after the other, appended as
+        each k is computed, <path>.offsets the start of each k in it (int64, one more than the k's) and <path>.json
+        the k's and the key of the inputs. The json is written last, so a cover map without it is incomplete.
+        Loaded cover maps map each k to a slice of a numpy.memmap of the ids.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.ks = []
+        self.offsets = [0]
+        if os.path.exists(path + ".json"):
+            os.remove(path + ".json")
+        self.ids_file = open(path + ".ids", 'wb')
+
+    def append(self, k, ids):
+        import numpy
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        assert len(ids) == 0 or (ids.min() >= 0 and ids.max() < 1 << 32)
+        ids.astype(numpy.uint32).tofile(self.ids_file)
+        self.ks.append(k)
+        self.offsets.append(self.offsets[-1] + len(ids))
+
+    def close(self):
+        import numpy
+        self.ids_file.close()
+        numpy.array(self.offsets, dtype=numpy.int64).tofile(self.path + ".offsets")
+        with open(self.path + ".json", 'w') as f:
+            json.dump({"key": self.key, "ks": self.ks}, f)
+
+    @staticmethod
+    def load(path, key):
+        # None if there is no complete cover map at path or if it was computed from other inputs
+        import numpy
+        if not os.path.exists(path + ".json"):
+            return None
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        if meta["key"] != key:
+            logging.info("%s is stale, ignoring it", path)
+            return None
+
+        offsets = numpy.fromfile(path + ".offsets", dtype=numpy.int64)
+        if offsets[-1] > 0:
+            ids = numpy.memmap(path + ".ids", dtype=numpy.uint32, mode='r', shape=(int(offsets[-1]),))
+        else:
+            # empty files can not be mapped
+            ids = numpy.zeros(0, dtype=numpy.uint32)
+        return {k: ids[offsets[i]:offsets[i + 1]] for i, k in enumerate(meta["ks"])}
+
+
+# state shared with the evaluation workers (inherited when the pool forks rather than pickled for each task)
+mp_eval_state = None
+
+
+def mp_compute_cover_map(task):
+    # cover map of one shard of one of the flow sets, with flow ids of the whole set
+    name, shard = task
+    flows, clusters, feature, intent_info, shards = mp_eval_state[name]
+    ids = shards[shard]
+    cover_map = IncrementalCoverMapGenerator(name, [flows[f] for f in ids], clusters, feature).compute_cover_map(intent_info)
+    return name, {k: [ids[f] for f in accepted] for k, accepted in cover_map.items()}
+
+
+def index_partition(flows, feature, shards):
+    """
+        Flow ids split into shards as the top level subtrees of an R-tree bulk loaded with sort-tile-recursive over
+        the interval embedding of the features (see Labeling.interval): the flows are sorted along the first
+        feature and cut into slabs, each slab along the next feature, and so on. Each shard is then a compact
+        region, so its own index is tight and an intent only reaches the shards it overlaps.
+        Without any feature with an embedding, the shards are ranges of ids.
+    """
+    boxes = [TupleIndex(feature).get_box(Spec(0, f)) for f in flows]
+    dims = [d for d in range(len(boxes[0]) if boxes else 0) if boxes[0][d] is not None]
+
+    def split(ids, count):
+        # count chunks of about the same size, in order
+        return [ids[len(ids) * i // count:len(ids) * (i + 1) // count] for i in range(count)]
+
+    def tile(ids, count, dims):
+        if count <= 1 or not dims:
+            return split(ids, count)
+        ids = sorted(ids, key=lambda f: sum(boxes[f][dims[0]]))
+        slabs = min(count, int(math.ceil(count ** (1.0 / len(dims)))))
+        res = []
+        for i, slab in enumerate(split(ids, slabs)):
+            res += tile(slab, count * (i + 1) // slabs - count * i // slabs, dims[1:])
+        return res
+
+    return [shard for shard in tile(list(range(len(flows))), shards, dims) if shard]
+
+
+def compute_cover_maps_parallel(generators, intent_info, processes):
+    """
+        Cover maps of several generators at once: the flows of all of them are split into shards of about the same
+        size (so a large negative set is spread over all the workers) by index partition (see index_partition),
+        each shard is indexed and evaluated on its own, and the shards of each generator are merged per k.
+    """
+    from multiprocessing import Pool
+
+    global mp_eval_state
+    intent_info = list(intent_info)
+    total = sum([len(g.flows) for g in generators])
+    shard_size = max(1, -(-total // (2 * processes)))
+    mp_eval_state = {g.name: (g.flows, g.clusters, g.feature, intent_info,
+                              index_partition(g.flows, g.feature, -(-len(g.flows) // shard_size)))
+                     for g in generators}
+    tasks = [(name, shard) for name, state in mp_eval_state.items() for shard in range(len(state[-1]))]
+
+    cover_maps = {g.name: {info.k: [] for info in intent_info} for g in generators}
+    start_time = time.time()
+    pool = Pool(processes)
+    for name, cover_map in pool.imap_unordered(mp_compute_cover_map, tasks):
+        for k, accepted in cover_map.items():
+            cover_maps[name][k] += accepted
+    pool.close()
+    pool.join()
+    mp_eval_state = None
+    logging.info("Finished computing %s cover maps in %s shards in %s seconds",
+                 len(generators), len(tasks), time.time() - start_time)
+
+    for cover_map in cover_maps.values():
+        for k in cover_map:
+            cover_map[k].sort()
+    return [cover_maps[g.name] for g in generators]
+
+def store_results_csv(res, filename, columns=None):
+    # res: k -> {column: value}, as returned by the evaluators; rows in the order of res
+    if columns is None:
+        columns = list(next(iter(res.values())).keys()) if res else []
+    with open(filename, 'w') as f:
+        f.write(",".join(["k"] + columns) + "\n")
+        for k, r in res.items():
+            f.write(",".join(map(str, [k] + [r[c] for c in columns])) + "\n")
+
+
+class EvaluationResults(object):
+    """
+        Threshold queries over the res of an evaluator (k -> {tp, fp, fn, ...}) by binary search.
+        Precision is tp / (tp + fp) (tp / cardinality_sum without fp) and recall tp / (tp + fn).
+        Neither is assumed to be monotone in k: the searches are over running maxima, which are, so the answers
+        are exact. Queries take a threshold or a list of them (and then return a list).
+    """
+    def __init__(self, res):
+        import numpy
+        ks = sorted(res)
+        self.ks = numpy.array(ks)
+        tp = numpy.array([res[k]["tp"] for k in ks], dtype=float)
+        if ks and "fp" in res[ks[0]]:
+            pp = tp + numpy.array([res[k]["fp"] for k in ks], dtype=float)
+        else:
+            pp = numpy.array([res[k]["cardinality_sum"] for k in ks], dtype=float)
+        self.precision = numpy.divide(tp, pp, out=numpy.ones(len(ks)), where=pp > 0)
+        if ks and "fn" in res[ks[0]]:
+            ap = tp + numpy.array([res[k]["fn"] for k in ks], dtype=float)
+            self.recall = numpy.divide(tp, ap, out=numpy.ones(len(ks)), where=ap > 0)
+        else:
+            self.recall = None
+
+        # running maxima of precision from the largest k down and of recall from the smallest k up
+        self.precision_max = numpy.maximum.accumulate(self.precision[::-1])
+        self.recall_max = numpy.maximum.accumulate(self.recall) if self.recall is not None else None
+
+    @staticmethod
+    def from_csv(filename):
+        # results stored by store_results_csv
+        with open(filename) as f:
+            columns = f.readline().strip().split(",")
+            res = {}
+            for line in f:
+                values = [float(v) if "." in v or "e" in v else int(v) for v in line.strip().split(",")]
+                res[values[0]] = dict(zip(columns[1:], values[1:]))
+        return EvaluationResults(res)
+
+    @staticmethod
+    def _query(running_max, ks, thresholds):
+        # k at the first position where running_max >= threshold, None if there is none
+        import numpy
+        single = numpy.isscalar(thresholds)
+        positions = numpy.searchsorted(running_max, numpy.atleast_1d(thresholds), side="left")
+        res = [ks[p].item() if p < len(ks) else None for p in positions]
+        return res[0] if single else res
+
+    def largest_k_with_precision(self, thresholds):
+        return self._query(self.precision_max, self.ks[::-1], thresholds)
+
+    def smallest_k_with_recall(self, thresholds):
+        assert self.recall is not None, "recall needs fn in the results"
+        return self._query(self.recall_max, self.ks, thresholds)
+
+
+class SummaryEvaluator(object):
+    """
+        Evaluates the summary of the clustered flows themselves in a single sweep over the intents, linear in their
+        size (Python version of EvalSummarization in cpp/Eval.h). Every flow stays under one of the remaining
+        clusters at every k, so tp is the size of all the flows and fn is 0 without checking coverage flow by
+        flow; fp is an upper bound, as flows in the overlap of clusters are counted more than once.
+        The size is the cardinality of the labels by default, so that tp and fp count flows like the cover map based
+        evaluators; the C++ version sums the cost of the clusters instead (quantity="cost"), which only differs for
+        labelings whose cost is not their cardinality. The cost column is the cost of the clusters either way.
+        The cover map based evaluators are only needed for flows that were not clustered (e.g. samples).
+    """
+    def __init__(self, flows, clusters, feature, quantity="cardinality"):
+        assert quantity in ["cardinality", "cost"]
+        self.flows = flows
+        self.clusters = clusters
+        self.feature = feature
+        self.quantity = quantity
+
+    def evaluate(self, intent_info):
+        if self.quantity == "cost":
+            size = self.feature.labeling.cost
+        else:
+            size = self.feature.labeling.cardinality
+        tp = sum([size(f) for f in self.flows])
+
+        res = {}
+        cost = 0
+        size_sum = 0
+        for info in intent_info:
+            cost += sum([self.clusters[c].cost for c in info.added]) - sum([self.clusters[c].cost for c in info.removed])
+            size_sum += sum([size(self.clusters[c].value) for c in info.added]) - \
+                        sum([size(self.clusters[c].value) for c in info.removed])
+            res[info.k] = {"tp": tp, "fp": size_sum - tp, "fn": 0, "cost": cost}
+
+        return res
+
+    def store_csv(self, res, dir="./"):
+        store_results_csv(res, dir + "/summary_eval.csv", ["tp", "fp", "fn", "cost"])
+
+
+class PerClusterEvaluator(object):
+    """
+        Per cluster evaluation of the summary (Python version of PerClusterEval in cpp/Eval.h): tp of a cluster is
+        the size of the flows in its subtree of the dendrogram, aggregated bottom-up along the parents in a single
+        pass, and pp (predicted positive) is its own size. k is the number of remaining clusters when it was created.
+        The size is the cardinality of the labels by default, like the other evaluators here count flows; the C++
+        version uses the cost of the clusters instead (quantity="cost"), which only differs for labelings whose
+        cost is not their cardinality (e.g. hierarchies with explicit cardinalities, or a top_card of d-values).
+        Rows are produced (and written) as soon as the subtree of their cluster is complete, so in post-order rather
+        than by cluster id; only the running tp and the number of pending children are kept per cluster.
+    """
+    def __init__(self, clusters, feature, quantity="cardinality"):
+        assert quantity in ["cardinality", "cost"]
+        self.clusters = clusters
+        self.feature = feature
+        self.quantity = quantity
+        self.ap = 0
+
+    def size(self, c):
+        if self.quantity == "cost":
+            return self.clusters[c].cost
+        return self.feature.labeling.cardinality(self.clusters[c].value)
+
+    def iter_results(self, dendrogram):
+        # (cluster, k, tp, pp, precision) of each cluster; ap is set before the first one
+        parents = dendrogram.parents
+        n = len(parents)
+        start_time = time.time()
+
+        tp = [0] * n
+        for f in dendrogram.get_flows():
+            tp[f] = self.size(f)
+        self.ap = sum([tp[f] for f in dendrogram.get_flows()])
+
+        initial_k = dendrogram.k[0] if len(dendrogram) else n
+        created = dendrogram.created
+
+        # post-order without children lists: a cluster is passed to its parent once all of its children were
+        pending = [0] * n
+        for c in range(n):
+            if parents[c] != c:
+                pending[parents[c]] += 1
+        ready = [c for c in range(n) if pending[c] == 0]
+        while ready:
+            c = ready.pop()
+            pp = self.size(c)
+            k = dendrogram.k[created[c]] if c < len(created) and created[c] > 0 else initial_k
+            yield c, k, tp[c], pp, tp[c] / pp if pp else 0.0
+            p = parents[c]
+            if p != c:
+                tp[p] += tp[c]
+                pending[p] -= 1
+                if pending[p] == 0:
+                    ready.append(p)
+
+        logging.info("Finished per cluster evaluation of %s clusters in %s seconds", n, time.time() - start_time)
+
+    def store_csv(self, dendrogram, dir="./", chunk_size=100000):
+        with open(dir + "/summary_eval_per_cluster.csv", 'w') as f:
+            f.write("cluster,k,tp,pp,precision,ap\n")
+            lines = []
+            for r in self.iter_results(dendrogram):
+                lines.append("%s,%s,%s,%s,%s,%s\n" % (r + (self.ap,)))
+                if len(lines) >= chunk_size:
+                    f.writelines(lines)
+                    lines = []
+            f.writelines(lines)
+
+
+def value_array(values):
+    """
+        numpy array of per flow (or cluster) values that do not change between k's, such as cardinalities.
+        int64 unless a sum of them could overflow it, in which case the (exact) Python ints are kept.
+    """
+    import numpy
+    values = numpy.array(values, dtype=None if len(values) else numpy.int64)
+    if values.dtype.kind in "iu" and len(values) and int(abs(values).max()) * len(values) >= 1 << 63:
+        values = values.astype(object)
+    return values
+
+
+def sums_per_step(values, ids_per_step):
+    # sum of values[ids] for each step: a gather and a sum each
+    import numpy
+    return numpy.array([values[numpy.asarray(ids, dtype=numpy.intp)].sum() for ids in ids_per_step],
+                       dtype=values.dtype)
+
+
+def prefix_sums(values, ids_per_step):
+    # running total of the sums per step, as Python numbers
+    import numpy
+    return numpy.cumsum(sums_per_step(values, ids_per_step)).tolist()
+
 
 class IncrementalCostBasedEvaluator(object):
     def __init__(self, flows, clusters, feature):
@@ -196,59 +568,71 @@ class IncrementalCostBasedEvaluator(object):
 
     def evaluate(self, intent_info, args):
         cover_map = self.cover_map_gen.get_cover_map(intent_info, args)
+        intent_info = list(intent_info)
 
-        tp = 0
-        res = {}
-        original_cost = 0
-        card_sum = 0
+        cardinality = self.feature.labeling.cardinality
+        flow_card = value_array([cardinality(f) for f in self.flows])
+        cluster_card = value_array([cardinality(c.value) for c in self.clusters])
+        cluster_cost = value_array([c.cost for c in self.clusters])
 
-        for info in intent_info:
-            k = info.k
-            tp += sum([self.feature.labeling.cardinality(self.flows[f]) for f in cover_map[k]])
-            original_cost += \
-                sum([self.clusters[c].cost for c in info.added]) - sum([self.clusters[c].cost for c in info.removed])
-            card_sum += sum([self.feature.labeling.cardinality(self.clusters[c].value) for c in info.added]) - \
-                        sum([self.feature.labeling.cardinality(self.clusters[c].value) for c in info.removed])
-            res[k] = {"tp": tp, "cost": original_cost, "cardinality_sum": card_sum}
-            logging.info(k, res[k])
+        tp = prefix_sums(flow_card, [cover_map[info.k] for info in intent_info])
+        added = [info.added for info in intent_info]
+        removed = [info.removed for info in intent_info]
+        costs = [a - r for a, r in zip(prefix_sums(cluster_cost, added), prefix_sums(cluster_cost, removed))]
+        card_sums = [a - r for a, r in zip(prefix_sums(cluster_card, added), prefix_sums(cluster_card, removed))]
+
+        res = {}
+        for step, info in enumerate(intent_info):
+            res[info.k] = {"tp": tp[step], "cost": costs[step], "cardinality_sum": card_sums[step]}
+            logging.info("%s %s", info.k, res[info.k])
 
         return res
 
 
 class IncrementalSampleBasedEvaluator(object):
-    def __init__(self, p_flows, n_flows, clusters, feature):
+    # with processes > 1, the positive and negative cover maps are computed by a pool of workers
+    def __init__(self, p_flows, n_flows, clusters, feature, processes=1):
         self.p_cover_map_gen = IncrementalCoverMapGenerator("positive", p_flows, clusters, feature)
         self.n_cover_map_gen = IncrementalCoverMapGenerator("negative", n_flows, clusters, feature)
         self.p_flows = p_flows
         self.n_flows = n_flows
         self.clusters = clusters
         self.feature = feature
-
+        self.processes = processes
+
+    def get_cover_maps(self, intent_info, args):
+        generators = [self.p_cover_map_gen, self.n_cover_map_gen]
+        if self.processes <= 1:
+            return [g.get_cover_map(intent_info, args) for g in generators]
+
+        intent_info = list(intent_info)
+        cover_maps = [g.load_cover_map(intent_info, args) for g in generators]
+        missing = [g for g, cover_map in zip(generators, cover_maps) if cover_map is None]
+        if missing:
+            computed = compute_cover_maps_parallel(missing, intent_info, self.processes)
+            for g, cover_map in zip(missing, computed):
+                g.store_cover_map(cover_map, intent_info, args)
+                cover_maps[generators.index(g)] = cover_map
+        return cover_maps
 
     def evaluate(self, intent_info, args):
-        p_cover_map = self.p_cover_map_gen.get_cover_map(intent_info, args)
-        n_cover_map = self.n_cover_map_gen.get_cover_map(intent_info, args)
+        p_cover_map, n_cover_map = self.get_cover_maps(intent_info, args)
+        intent_info = list(intent_info)
 
-        tp = 0
-        fp = 0
-        tn = sum([self.feature.labeling.cardinality(f) for f in self.n_flows])
-        fn = sum([self.feature.labeling.cardinality(f) for f in self.p_flows])
+        # cardinalities of the flows are computed once, then each k is a gather and a sum
+        cardinality = self.feature.labeling.cardinality
+        p_card = value_array([cardinality(f) for f in self.p_flows])
+        n_card = value_array([cardinality(f) for f in self.n_flows])
 
-        res = {}
+        tp = prefix_sums(p_card, [p_cover_map[info.k] for info in intent_info])
+        fp = prefix_sums(n_card, [n_cover_map[info.k] for info in intent_info])
+        # as Python numbers, like tp and fp (cardinalities may be fractional)
+        p_total = p_card.sum(keepdims=True).tolist()[0]
+        n_total = n_card.sum(keepdims=True).tolist()[0]
 
-        uncovered_negative = set(range(len(self.n_flows)))
-
-        for info in intent_info:
-            k = info.k
-            p_new_covered = sum([self.feature.labeling.cardinality(self.p_flows[f]) for f in p_cover_map[k]])
-            n_new_covered = sum([self.feature.labeling.cardinality(self.n_flows[f]) for f in n_cover_map[k]])
-            tp += p_new_covered
-            fp += n_new_covered
-            tn -= n_new_covered
-            fn -= p_new_covered
-
-            res[k] = {"tp": tp, "fp": fp, "tn": tn, "fn": fn}
-            logging.info(k, res[k])
+        res = {}
+        for step, info in enumerate(intent_info):
+            res[info.k] = {"tp": tp[step], "fp": fp[step], "tn": n_total - fp[step], "fn": p_total - tp[step]}
+            logging.info("%s %s", info.k, res[info.k])
 
         return res
-
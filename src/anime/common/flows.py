@@ -0,0 +1,130 @@
+__author__ = "Ali Kheradmand"
+__email__ =  "kheradm2@illinois.edu"
+
+"""
+    Streaming readers of flow files and a columnar store that interns their labels as they are read
+"""
+
+from array import array
+
+from anime.framework.labeling import *
+from anime.framework.ip_labeling import *
+from anime.framework.hregex import *
+
+
+class FlowStore(object):
+    """
+        Flows as columns of label ids: each distinct key (the parsed text of a label) of a column is made into a
+        label once, and every flow only adds one uint32 id per column. Records are consumed one at a time, so
+        nothing but the store itself is kept while loading.
+        A store is a sequence of flows (tuples of labels), as expected by the clustering.
+    """
+
+    def __init__(self, columns):
+        # columns: (name, function making the label of a key) per column
+        self.names = [name for name, _ in columns]
+        self.makers = [make for _, make in columns]
+        self.labels = [[] for c in columns]
+        self.label_ids = [{} for c in columns]
+        self.ids = [array('I') for c in columns]
+
+    def intern(self, column, key):
+        ids = self.label_ids[column]
+        if key not in ids:
+            ids[key] = len(self.labels[column])
+            self.labels[column].append(self.makers[column](key))
+        return ids[key]
+
+    def append(self, record):
+        assert len(record) == len(self.ids)
+        for column, key in enumerate(record):
+            self.ids[column].append(self.intern(column, key))
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+        return self
+
+    def __len__(self):
+        return len(self.ids[0]) if self.ids else 0
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return tuple(labels[ids[i]] for labels, ids in zip(self.labels, self.ids))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def column_labels(self, name):
+        # distinct labels of a column
+        return self.labels[self.names.index(name)]
+
+
+def read_path_lines(lines, ip=False):
+    """
+        One flow per (non empty) line: the hops of its path, after its dst IP prefix if ip is set.
+        Yields (path,) or (ip, path) records, with the path as a tuple of hops.
+    """
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) == 0:
+            continue
+        if ip:
+            yield tokens[0], tuple(tokens[1:])
+        else:
+            yield tuple(tokens),
+
+
+def read_cpp_flows(lines, label_names, ranges=False):
+    """
+        Flows written by PREFIX_SRC_DST_FlowSerializer ("prefix src_id dst_id") or, with ranges set,
+        RANGE_SRC_DST_FlowSerializer ("begin end src_id dst_id") of cpp/cites.h; like the C++ readers, any
+        whitespace separates the fields. label_names: label of each id of the hierarchy (see read_cpp_hierarchy).
+        Yields (prefix, src, dst) records; ranges are given as the prefix they span.
+    """
+    tokens = (t for line in lines for t in line.split())
+    fields = 4 if ranges else 3
+    for record in zip(*[tokens] * fields):
+        if ranges:
+            prefix = range_to_prefix(int(record[0]), int(record[1]))
+        else:
+            prefix = record[0]
+        yield prefix, label_names[int(record[-2])], label_names[int(record[-1])]
+
+
+def range_to_prefix(begin, end):
+    # the Python side only has prefix labelings, so ranges must be prefixes
+    cidrs = netaddr.iprange_to_cidrs(netaddr.IPAddress(begin), netaddr.IPAddress(end))
+    assert len(cidrs) == 1, "range %s-%s is not a prefix" % (begin, end)
+    return str(cidrs[0])
+
+
+def read_cpp_hierarchy(lines):
+    """
+        Hierarchy in the format of LabelHierarchy::load_from_file in cpp/Feature.h ("label cost parents..." per
+        line, parents first). Returns the label info (as loaded by HierarchicalLabeling) and the label of each id
+        (ids are line numbers, as in C++).
+    """
+    label_info = {}
+    names = []
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) == 0:
+            continue
+        cost = float(tokens[1])
+        label_info[tokens[0]] = {"cost": int(cost) if cost.is_integer() else cost, "parents": tokens[2:]}
+        names.append(tokens[0])
+    return label_info, names
+
+
+def path_store(ip=False):
+    columns = [("path", lambda hops: HRegex(list(hops)))]
+    if ip:
+        columns.insert(0, ("dst ip", IPv4Prefix))
+    return FlowStore(columns)
+
+
+def cpp_flow_store():
+    return FlowStore([("dst ip", IPv4Prefix), ("src", str), ("dst", str)])
@@ -5,40 +5,192 @@ __email__ =  "kheradm2@illinois.edu"
     Various clustering algorithms
 """
 
+import os
 import time
 import random
 import heapq
 import logging
 import pickle
 import collections
+import math
+import numbers
+from .labeling import Spec
+from .dendrogram import Dendrogram, IncrementalIntentInfo
+from .metrics import Metrics, NullMetrics
 
 class Clustering(object):
     pass
 
 plot = False
 
+# batches smaller than this are not worth converting to arrays
+bulk_distance_min_batch = 16
 
-def join_cost_distance(a, b, joined):
-    return joined.cost
+# costs up to this are exact in float64, and so are sums and differences of three of them
+bulk_distance_max_cost = 2 ** 51
 
 
-def cost_gain_distance(a, b, joined):
-    return joined.cost - a.cost - b.cost
+def cost_log(x):
+    # natural log of a number, or elementwise of a numpy array
+    if isinstance(x, numbers.Number):
+        return math.log(x)
+    import numpy
+    return numpy.log(x)
+
+
+class DistanceMeasure(object):
+    """
+        Distance measures get the two clusters and the join of them; only the cost of the join is known (value is None).
+        A DistanceMeasure is defined by an expression over the three costs that only uses arithmetic (and cost_log),
+        so that it can also be evaluated for a whole batch of pairs at once on numpy arrays (in float64). Batches with
+        costs that float64 can not hold exactly (e.g. large products of tuple labelings) are evaluated pair by pair.
+        Any other callable taking (a, b, joined) can be used as a distance measure, but is called once per pair.
+    """
+
+    def __init__(self, name, expression, max_joined_cost=None):
+        self.name = name
+        self.expression = expression
+        # (cost_a, cost_b, max_distance) -> the largest join cost with a distance of at most max_distance,
+        # for measures that increase with the join cost (used to bound joins); measures without it are not bounded
+        self.max_joined_cost = max_joined_cost
+
+    def __call__(self, a, b, joined):
+        return self.expression(a.cost, b.cost, joined.cost)
+
+    def bulk(self, cost_a, costs_b, costs_joined):
+        # distances between a cluster of cost cost_a and clusters of costs costs_b, as a list
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None and isinstance(cost_a, (int, float)) and abs(cost_a) <= bulk_distance_max_cost:
+            # the type and range of the costs are checked on the arrays: ints beyond int64 (and anything that is
+            # not a number) make object arrays, mixed ints and floats make float arrays of at least the same range
+            arrays = [numpy.asarray(costs_b), numpy.asarray(costs_joined)]
+            if all(a.dtype.kind in "iuf" and (a.size == 0 or numpy.abs(a).max() <= bulk_distance_max_cost)
+                   for a in arrays):
+                costs_b, costs_joined = [a.astype(float) for a in arrays]
+                distances = self.expression(float(cost_a), costs_b, costs_joined)
+                return numpy.broadcast_to(distances, costs_joined.shape).tolist()
+        return [self.expression(cost_a, b, j) for b, j in zip(costs_b, costs_joined)]
+
+    def __repr__(self):
+        return self.name
+
+
+def join_cost_expression(cost_a, cost_b, cost_joined):
+    return cost_joined
+
+
+def cost_gain_expression(cost_a, cost_b, cost_joined):
+    return cost_joined - cost_a - cost_b
+
+
+def normalized_gain_expression(cost_a, cost_b, cost_joined):
+    # fraction of the joined cluster that is not covered by the two clusters
+    return (cost_joined - cost_a - cost_b) / cost_joined
+
+
+def log_cost_gain_expression(cost_a, cost_b, cost_joined):
+    # relative growth, so that merges of large clusters are not always postponed
+    return cost_log(cost_joined) - cost_log(cost_a + cost_b)
+
+
+join_cost_distance = DistanceMeasure("join_cost_distance", join_cost_expression,
+                                     lambda cost_a, cost_b, max_distance: max_distance)
+cost_gain_distance = DistanceMeasure("cost_gain_distance", cost_gain_expression,
+                                     lambda cost_a, cost_b, max_distance: max_distance + cost_a + cost_b)
+normalized_gain_distance = DistanceMeasure("normalized_gain_distance", normalized_gain_expression)
+log_cost_gain_distance = DistanceMeasure("log_cost_gain_distance", log_cost_gain_expression)
+
+class DenseSet(object):
+    """
+        Set of cluster ids kept in a dense list, for O(1) add/remove and uniform sampling.
+        Iteration order only depends on the sequence of operations (not on hashing), and survives pickling.
+    """
+
+    def __init__(self, items=()):
+        self.items = []
+        self.positions = {}
+        for x in items:
+            self.add(x)
+
+    def __contains__(self, x):
+        return x in self.positions
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __isub__(self, other):
+        for x in other:
+            self.discard(x)
+        return self
+
+    def add(self, x):
+        if x not in self.positions:
+            self.positions[x] = len(self.items)
+            self.items.append(x)
+
+    def discard(self, x):
+        pos = self.positions.pop(x, None)
+        if pos is None:
+            return
+        last = self.items.pop()
+        if pos < len(self.items):
+            self.items[pos] = last
+            self.positions[last] = pos
+
+    def sample(self, count):
+        return random.sample(self.items, count)
 
-IncrementalIntentInfo = collections.namedtuple('IncrementalIntentInfo', ['k', 'added', 'removed'])
 
 class HierarchicalClustering(Clustering):
     def __init__(self, cluster_count=1, batch_size=0, distance_measure=cost_gain_distance,
-                 closest_clusters_bucket_size=3):
+                 closest_clusters_bucket_size=3, checkpoint_path=None, checkpoint_every=0, checkpoint_interval=0,
+                 max_cost=None, max_cost_ratio=None, time_budget=None, plateau_window=0, plateau_growth=0.5,
+                 locality_fraction=0, subsumption_index=False, metrics=False, index_class=None):
         self.cluster_count = cluster_count
         self.batch_size = batch_size
         self.distance_measure = distance_measure
         self.closest_clusters_bucket_size = closest_clusters_bucket_size
 
+        # fraction of each batch taken from clusters that share a locality key (see Labeling.locality_keys)
+        # with the cluster the batch is for, rather than sampled uniformly
+        self.locality_fraction = locality_fraction
+        self.locality_buckets = {}
+
+        # find the clusters subsumed by a new cluster with a containment index (exact) rather than in random batches
+        self.subsumption_index = subsumption_index
+        self.index = None
+        # class of the index (where one is used), RTreeIndex by default; TupleIndex bounds each feature on its own
+        self.index_class = index_class
+
+        # call counters and phase timers (see Metrics), off by default
+        self.metrics = Metrics() if metrics else NullMetrics()
+
+        # periodic checkpoints: every checkpoint_every merges and/or every checkpoint_interval seconds
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+
+        # early stop: the clustering stops before reaching cluster_count as soon as one of these criteria is met
+        # - overall cost exceeds max_cost
+        # - overall cost exceeds max_cost_ratio times the initial cost
+        # - more than time_budget seconds have passed
+        # - the cost leaves its plateau: it grew by more than plateau_growth (relative) in the last plateau_window merges
+        self.max_cost = max_cost
+        self.max_cost_ratio = max_cost_ratio
+        self.time_budget = time_budget
+        self.plateau_window = plateau_window
+        self.plateau_growth = plateau_growth
+        self.stop_reason = None
+
         self.clusters = []
-        self.parents = []
-        self.stats = []
-        self.intents = [] # (k, added, removed)
+        # parents, intents (k, added, removed) and stats (k, cost, time) of each step
+        self.dendrogram = Dendrogram()
 
         # optimization: keep only a few closets clusters per cluster rather than distance to all clusters,
         # recompute the rest only when necessary
@@ -47,206 +199,494 @@ class HierarchicalClustering(Clustering):
         # places where recount happened
         self.closest_clusters_recomputations = []
 
-    def cluster(self, flows, feature, callback=None):
-        flow_labeling = feature.labeling
-
-        batch_size = self.batch_size
-        if batch_size == 0:
-            batch_size = len(flows)
+        # state of an ongoing clustering, kept on the object so that it can be checkpointed
+        self.heap = []
+        self.remaining_clusters = DenseSet()
+        self.overall_cost = 0
 
-        self.clusters = [flow_labeling.join(flow, flow) for flow in flows]
-        self.parents = list(range(len(self.clusters)))
-        self.closest_clusters = [[]] * len(self.clusters)
+    @property
+    def parents(self):
+        return self.dendrogram.parents
 
-        logging.info("Initial clusters added")
+    @property
+    def intents(self):
+        return self.dendrogram
 
-        heap = []
-        overall_cost = sum([c.cost for c in self.clusters])
-
-        start = time.time()
+    @property
+    def stats(self):
+        return list(self.dendrogram.iter_stats())
 
-        def update_closest_clusters(i, batch, check_subsumption=False, update_other=True):
-            subsumed = []
-            for j in batch:
-                if check_subsumption and flow_labeling.subset(self.clusters[j].value, self.clusters[i].value):
-                    subsumed.append(j)
-                    logging.info("%s %s subsuming %s : %s", i, self.clusters[i].value, j, self.clusters[j])
-                    #overall_cost -= self.clusters[c].cost
-                else:
-                    spec = flow_labeling.join(self.clusters[i].value, self.clusters[j].value)
-                    distance = self.distance_measure(self.clusters[i], self.clusters[j], spec)
+    def cut(self, k):
+        return self.dendrogram.cut(k, self.clusters)
 
-                    self.closest_clusters[i] = sorted(self.closest_clusters[i] + [(distance, spec, (i, j))]) \
-                        [:self.closest_clusters_bucket_size]
+    def cuts(self, ks):
+        return self.dendrogram.cuts(ks, self.clusters)
 
-                    if update_other:
-                        self.closest_clusters[j] = sorted(self.closest_clusters[j] + [(distance, spec, (j, i))]) \
-                            [:self.closest_clusters_bucket_size]
+    def cluster(self, flows, feature, callback=None):
+        self.flow_labeling = feature.labeling
+        self.flow_feature = feature
+        self.metrics.instrument(feature.labeling, feature.name)
+        try:
+            self.flow_count = len(flows)
 
-            return subsumed
+            self.effective_batch_size = self.batch_size
+            if self.effective_batch_size == 0:
+                self.effective_batch_size = len(flows)
 
-        def get_batch():
-            if len(remaining_clusters) <= batch_size:
-                # just go through everything
-                batch = remaining_clusters
-            else:
-                # sample a random batch
-                batch = set()
-
-                # choosing the more efficient way of sampling:
-                if (float(len(self.clusters)) / len(remaining_clusters)) * batch_size < len(remaining_clusters):
-                    while len(batch) < batch_size:
-                        r = random.randint(0, len(self.clusters) - 1)
-                        if r in remaining_clusters:
-                            batch.add(r)
-                else:
-                    batch = set(random.sample(remaining_clusters, batch_size))
+            self.clusters = [self.flow_labeling.join(flow, flow) for flow in flows]
+            self.dendrogram = Dendrogram(len(self.clusters))
+            self.closest_clusters = [[]] * len(self.clusters)
 
-            return batch
+            logging.info("Initial clusters added")
 
-        def get_closest_cluster(c, recompute_if_empty=False):
-            assert c in remaining_clusters
-            while len(self.closest_clusters[c]) > 0:
-                if self.closest_clusters[c][0][2][1] in remaining_clusters:
-                    return self.closest_clusters[c][0]
-                else:
-                    self.closest_clusters[c] = self.closest_clusters[c][1:]
+            self.heap = []
+            self.overall_cost = sum([c.cost for c in self.clusters])
 
-            if recompute_if_empty and len(self.closest_clusters[c]) == 0:
-                update_closest_clusters(c, get_batch() - set([c]), check_subsumption=False, update_other=False)
-                self.closest_clusters_recomputations.append(len(remaining_clusters))
-                return get_closest_cluster(c)
-            else:
-                return None
+            self.start = time.time()
 
-            # all closes clusters consumed
+            self.remaining_clusters = DenseSet()
+            self.locality_buckets = {}
+            for c in range(len(flows)):
+                self.add_remaining(c)
 
+            with self.metrics.phase("initial_distances"):
+                self.initial_distances(feature)
 
+            self.record_step(sorted(self.remaining_clusters), [])
+            if callback:
+                callback(self, self.remaining_clusters)
+
+            return self.merge_clusters(callback)
+        finally:
+            self.metrics.uninstrument()
+
+    def resume(self, checkpoint, feature, callback=None):
+        """
+            Continues a clustering from a checkpoint file written during a previous (interrupted) run.
+            Apart from the timings in stats, the result is identical to the one of an uninterrupted run.
+        """
+        logging.info("Resuming clustering from %s", checkpoint)
+        with open(checkpoint, 'rb') as f:
+            state = pickle.load(f)
+
+        self.flow_labeling = feature.labeling
+        self.flow_feature = feature
+        self.metrics.instrument(feature.labeling, feature.name)
+        try:
+            self.load_checkpoint_state(state, feature)
+            random.setstate(state["random_state"])
+            self.start = time.time() - state["elapsed"]
+
+            return self.merge_clusters(callback)
+        finally:
+            self.metrics.uninstrument()
+
+    def merge_clusters(self, callback=None):
+        self.stop_reason = None
+        self.last_checkpoint_step = len(self.intents)
+        self.last_checkpoint_time = time.time()
+
+        while len(self.remaining_clusters) > self.cluster_count and not self.should_stop():
+            logging.info("Number of clusters so far %s", len(self.remaining_clusters))
+
+            with self.metrics.phase("heap_pop"):
+                best = self.pop_best()
 
-        remaining_clusters = set(range(len(flows)))
+            new_cluster_id = len(self.clusters)
+            best_distance = best[0]
+            best_clusters_to_merge = best[1:]
+            # the joined label is only materialized for the pair that is actually merged
+            best_new_cluster = self.flow_labeling.join(self.clusters[best_clusters_to_merge[0]].value,
+                                                       self.clusters[best_clusters_to_merge[1]].value)
+            logging.info("Final best distance is %s %s with cluster id %s by merging %s %s %s",
+                         best_distance, best_new_cluster, new_cluster_id, best_clusters_to_merge,
+                         self.clusters[best_clusters_to_merge[0]], self.clusters[best_clusters_to_merge[1]])
 
-        # initial distances
-        for i in range(len(self.clusters)):
-            logging.info("Adding distances for cluster %s", i)
+            self.overall_cost += best_new_cluster.cost - \
+                self.clusters[best_clusters_to_merge[0]].cost - self.clusters[best_clusters_to_merge[1]].cost
 
-            if len(self.clusters) - i <= batch_size:
-                batch = list(range(i + 1, len(self.clusters)))
-            else:
-                batch = [random.randint(i+1,len(self.clusters)-1) for x in range(batch_size)]
+            self.clusters.append(best_new_cluster)
+            self.remove_remaining(best_clusters_to_merge)
 
-            update_closest_clusters(i, batch)
-            min_dist = get_closest_cluster(i)
-            if min_dist:
-                heapq.heappush(heap, min_dist)
+            self.closest_clusters.append([])
 
-        self.stats.append((len(remaining_clusters), overall_cost, time.time() - start))
-        logging.info(self.stats[-1])
+            self.parents.append(new_cluster_id)
 
-        self.intents.append(IncrementalIntentInfo(len(remaining_clusters), list(remaining_clusters), []))
-        if callback:
-            callback(self, remaining_clusters)
+            with self.metrics.phase("subsumption"):
+                removed = self.remove_subsumed(new_cluster_id, best_clusters_to_merge)
 
-        while len(remaining_clusters) > self.cluster_count:
-            logging.info("Number of clusters so far %s", len(remaining_clusters))
+            self.add_remaining(new_cluster_id)
 
-            removed = []
+            with self.metrics.phase("add_cluster"):
+                self.add_new_cluster(new_cluster_id)
 
-            best = None
-            while True:
+            logging.info("Cumulative cost is %s", self.overall_cost)
+            self.record_step([new_cluster_id], removed)
+            if callback:
+                callback(self, self.remaining_clusters)
 
-                candidate = heapq.heappop(heap)
-                c_1, c_2 = candidate[2]
+            self.checkpoint_if_needed()
 
-                if c_1 in remaining_clusters:
-                    if c_2 in remaining_clusters:
-                        best = candidate
-                        break
-                    else:
-                        min_dist = get_closest_cluster(c_1, recompute_if_empty=True)
-                        if min_dist:
-                            heapq.heappush(heap, min_dist)
+        # clustering is done
+        logging.info("Clustering is finished")
+        logging.info(">time %s", str(time.time()-self.start))
+        logging.info(">recounts %s", len(self.closest_clusters_recomputations))
+        # self.store_stats_csv()
+        if plot:
+            self.plot_stats(sum((x.cost for x in self.clusters[:self.flow_count])))
+
+        return [self.clusters[c] for c in sorted(self.remaining_clusters)]
+
+    def add_remaining(self, c):
+        self.remaining_clusters.add(c)
+        if self.locality_fraction > 0:
+            for key in self.flow_labeling.locality_keys(self.clusters[c].value):
+                self.locality_buckets.setdefault(key, DenseSet()).add(c)
+
+    def remove_remaining(self, removed):
+        for c in removed:
+            self.remaining_clusters.discard(c)
+            if self.locality_fraction > 0:
+                for key in self.flow_labeling.locality_keys(self.clusters[c].value):
+                    self.locality_buckets[key].discard(c)
+
+    def record_step(self, added, removed):
+        self.dendrogram.append_step(len(self.remaining_clusters), added, removed,
+                                    self.overall_cost, time.time() - self.start)
+        logging.info(self.dendrogram.get_stats(-1))
+        if self.metrics.enabled:
+            self.metrics.end_step(len(self.remaining_clusters), heap_size=len(self.heap),
+                                  closest_clusters_recomputations=len(self.closest_clusters_recomputations),
+                                  index_depth=self.index.get_depth() if self.index is not None else 0)
+
+    def get_metrics(self):
+        # totals of the run so far, along with the current heap and index sizes
+        res = self.metrics.summary()
+        res["heap_size"] = len(self.heap)
+        res["closest_clusters_recomputations"] = len(self.closest_clusters_recomputations)
+        res["stale_pop_ratio"] = float(res.get("stale_pops", 0)) / res["heap_pops"] if res.get("heap_pops") else 0
+        if self.index is not None:
+            res.update(("index_" + name, value) for name, value in self.index.get_stats().items())
+        return res
+
+    def should_stop(self):
+        # the last step is the state after the last merge; the hierarchy so far stays valid when stopping
+        costs = self.dendrogram.cost
+        initial_cost = costs[0]
+        cost = costs[-1]
+
+        if self.max_cost is not None and cost > self.max_cost:
+            self.stop_reason = "max_cost"
+        elif self.max_cost_ratio is not None and cost > self.max_cost_ratio * initial_cost:
+            self.stop_reason = "max_cost_ratio"
+        elif self.time_budget is not None and time.time() - self.start > self.time_budget:
+            self.stop_reason = "time_budget"
+        elif 0 < self.plateau_window < len(costs) and \
+                cost > (1 + self.plateau_growth) * costs[-1 - self.plateau_window]:
+            self.stop_reason = "plateau"
+        else:
+            return False
+
+        logging.info("Stopping early at k=%s because of %s", len(self.remaining_clusters), self.stop_reason)
+        return True
+
+    def push_pair(self, entry):
+        # heap entries are totally ordered by (distance, smaller id, larger id), so the order of merges does not
+        # depend on the order in which entries are pushed (e.g. by parallel workers) nor on comparing labels
+        distance, i, j = entry
+        heapq.heappush(self.heap, (distance, min(i, j), max(i, j)))
+
+    def pop_best(self):
+        metrics = self.metrics
+        while True:
+            candidate = heapq.heappop(self.heap)
+            _, c_1, c_2 = candidate
+            metrics.count("heap_pops")
+
+            if c_1 in self.remaining_clusters:
+                if c_2 in self.remaining_clusters:
+                    return candidate
                 else:
-                    if c_2 in remaining_clusters:
-                        min_dist = get_closest_cluster(c_2, recompute_if_empty=True)
-                        if min_dist:
-                            heapq.heappush(heap, min_dist)
-
-            assert best is not None
+                    metrics.count("stale_pops")
+                    with metrics.phase("stale_refresh"):
+                        min_dist = self.refresh_closest_cluster(c_1)
+                    if min_dist:
+                        self.push_pair(min_dist)
+            else:
+                metrics.count("stale_pops")
+                if c_2 in self.remaining_clusters:
+                    with metrics.phase("stale_refresh"):
+                        min_dist = self.refresh_closest_cluster(c_2)
+                    if min_dist:
+                        self.push_pair(min_dist)
+
+    def update_closest_clusters(self, i, batch, check_subsumption=False, update_other=True):
+        subsumed = []
+        candidates = []
+        for j in batch:
+            if check_subsumption and self.flow_labeling.subset(self.clusters[j].value, self.clusters[i].value):
+                subsumed.append(j)
+                logging.info("%s %s subsuming %s : %s", i, self.clusters[i].value, j, self.clusters[j])
+                #overall_cost -= self.clusters[c].cost
+            else:
+                candidates.append(j)
+
+        candidates, costs = self.get_join_costs(i, candidates, update_other)
+        distances = self.get_distances(i, candidates, costs)
+
+        # keeping the closest of all candidates at once is the same as adding them one by one,
+        # as entries are totally ordered
+        bucket_size = self.closest_clusters_bucket_size
+        self.closest_clusters[i] = sorted(self.closest_clusters[i] + [(d, i, j) for d, j in zip(distances, candidates)]) \
+            [:bucket_size]
+
+        if update_other:
+            for d, j in zip(distances, candidates):
+                self.closest_clusters[j] = sorted(self.closest_clusters[j] + [(d, j, i)])[:bucket_size]
+
+        return subsumed
+
+    def get_join_costs(self, i, batch, update_other):
+        """
+            Costs of the joins of cluster i with the clusters in batch that can make it into the closest clusters
+            of i (or of the other cluster, with update_other). Once a bucket is full, only pairs that are not
+            farther than its farthest entry can, so joins with a larger cost are given up as early as possible.
+            Returns the clusters that made it and their join costs.
+        """
+        labeling = self.flow_labeling
+        max_joined_cost = getattr(self.distance_measure, "max_joined_cost", None)
+        bucket_size = self.closest_clusters_bucket_size
+        a = self.clusters[i]
+
+        def farthest(c):
+            return self.closest_clusters[c][-1][0] if len(self.closest_clusters[c]) >= bucket_size else None
+
+        farthest_i = farthest(i) if max_joined_cost is not None else None
+        if farthest_i is None:
+            return batch, [labeling.join_cost(a.value, self.clusters[j].value) for j in batch]
+
+        max_costs = []
+        for j in batch:
+            max_distance = farthest_i
+            if update_other:
+                farthest_j = farthest(j)
+                max_distance = None if farthest_j is None else max(max_distance, farthest_j)
+            max_costs.append(None if max_distance is None else
+                             max_joined_cost(a.cost, self.clusters[j].cost, max_distance))
+
+        # all at once, so that a tuple labeling can rule out candidates on its cheap features first
+        costs = labeling.join_costs_bounded(a.value, [self.clusters[j].value for j in batch], max_costs)
+
+        kept = [(j, cost) for j, cost in zip(batch, costs) if cost is not None]
+        self.metrics.count("bounded_joins_cut", len(batch) - len(kept))
+        return [j for j, _ in kept], [cost for _, cost in kept]
+
+    def get_distances(self, i, batch, costs):
+        # distances from cluster i to the clusters in batch, given the costs of their joins
+        if len(batch) >= bulk_distance_min_batch and hasattr(self.distance_measure, "bulk"):
+            return self.distance_measure.bulk(self.clusters[i].cost, [self.clusters[j].cost for j in batch], costs)
+        return [self.distance_measure(self.clusters[i], self.clusters[j], Spec(cost, None))
+                for j, cost in zip(batch, costs)]
+
+    def get_local_candidates(self, c, count):
+        # clusters in the same index leaf as c, then clusters sharing a locality key with c, finer keys first
+        candidates = set()
+        if self.index is not None:
+            candidates.update(x for _, x in self.index.get_leaf_neighbors(self.clusters[c])[:count])
+        for key in self.flow_labeling.locality_keys(self.clusters[c].value):
+            bucket = self.locality_buckets.get(key)
+            if not bucket:
+                continue
+            if len(bucket) <= count - len(candidates):
+                candidates.update(bucket)
+            else:
+                candidates.update(bucket.sample(count - len(candidates)))
+            if len(candidates) >= count:
+                break
+        candidates.discard(c)
+        return candidates
+
+    def get_batch(self, c=None):
+        # batches are returned in a fixed order so that a resumed clustering does not depend on set layout
+        batch_size = self.effective_batch_size
+        if len(self.remaining_clusters) <= batch_size:
+            # just go through everything
+            return sorted(self.remaining_clusters)
+
+        batch = set()
+        if c is not None and self.locality_fraction > 0:
+            batch.update(self.get_local_candidates(c, int(self.locality_fraction * batch_size)))
+
+        # sample the rest uniformly at random
+        while len(batch) < batch_size:
+            batch.update(self.remaining_clusters.sample(batch_size - len(batch)))
+
+        return sorted(batch)
+
+    def get_closest_cluster(self, c, recompute_if_empty=False):
+        assert c in self.remaining_clusters
+        while len(self.closest_clusters[c]) > 0:
+            if self.closest_clusters[c][0][2] in self.remaining_clusters:
+                return self.closest_clusters[c][0]
+            else:
+                self.closest_clusters[c] = self.closest_clusters[c][1:]
+
+        # all closes clusters consumed
+        if recompute_if_empty and len(self.closest_clusters[c]) == 0:
+            self.update_closest_clusters(c, [b for b in self.get_batch(c) if b != c],
+                                         check_subsumption=False, update_other=False)
+            self.closest_clusters_recomputations.append(len(self.remaining_clusters))
+            return self.get_closest_cluster(c)
+        else:
+            return None
+
+    def initial_distances(self, feature):
+        if self.subsumption_index:
+            self.build_index(feature)
+
+        batch_size = self.effective_batch_size
+        for i in range(len(self.clusters)):
+            logging.info("Adding distances for cluster %s", i)
 
-            new_cluster_id = len(self.clusters)
-            best_clusters_to_merge = best[2]
-            best_new_cluster = best[1]
-            best_distance = best[0]
-            logging.info("Final best distance is %s %s with cluster id %s by merging %s %s %s",
-                         best_distance, best_new_cluster, new_cluster_id, best_clusters_to_merge,
-                         self.clusters[best_clusters_to_merge[0]], self.clusters[best_clusters_to_merge[1]])
+            if len(self.clusters) - i <= batch_size:
+                batch = list(range(i + 1, len(self.clusters)))
+            else:
+                batch = [random.randint(i+1,len(self.clusters)-1) for x in range(batch_size)]
+                if self.locality_fraction > 0:
+                    batch += sorted(self.get_local_candidates(i, int(self.locality_fraction * batch_size)))
 
-            overall_cost += best_distance
+            self.update_closest_clusters(i, batch)
+            min_dist = self.get_closest_cluster(i)
+            if min_dist:
+                self.push_pair(min_dist)
 
-            self.clusters.append(best_new_cluster)
-            remaining_clusters -= set([best_clusters_to_merge[0], best_clusters_to_merge[1]])
-            removed += best_clusters_to_merge
+    def refresh_closest_cluster(self, c):
+        # the closest cluster of c has been merged, returns the next heap entry for c (if any)
+        return self.get_closest_cluster(c, recompute_if_empty=True)
 
+    def build_index(self, feature):
+        from .index import RTreeIndex
 
-            self.closest_clusters.append([])
+        self.index = (self.index_class or RTreeIndex)(feature)
 
-            self.parents.append(new_cluster_id)
-            self.parents[best_clusters_to_merge[0]] = new_cluster_id
-            self.parents[best_clusters_to_merge[1]] = new_cluster_id
+        logging.info("Indexing flows")
 
-            cost_sanity_check = self.clusters[new_cluster_id].cost
+        with self.metrics.phase("index_update"):
+            for i in range(len(self.clusters)):
+                self.index.insert(self.clusters[i], i)
 
-            min_dist = None
-            while True:
-                # choosing the batch to go through
-                batch = get_batch()
+        logging.info("Finished indexing flows in %s seconds", time.time()-self.start)
 
-                # now going through the batch
-                subsumed = update_closest_clusters(new_cluster_id, batch, check_subsumption=True, update_other=True)
+    def remove_index_subsets(self, new_cluster_id, merged):
+        # merged clusters are removed from the index along with the other subsumed ones
+        with self.metrics.phase("index_update"):
+            subsumed = self.index.get_subsets(self.clusters[new_cluster_id])
+            subsumed = [x[1] for x in subsumed]
+            self.index.remove_subset(self.clusters[new_cluster_id])
 
-                # remove subsumed clusters
-                overall_cost -= sum([self.clusters[c].cost for c in subsumed])
-                removed += subsumed
-                remaining_clusters -= set(subsumed)
+        # remove subsumed clusters (the cost of the merged ones is already accounted for)
+        self.overall_cost -= sum([self.clusters[c].cost for c in subsumed if c not in merged])
+        self.remove_remaining(subsumed)
 
-                for c in subsumed:
-                    self.parents[c] = new_cluster_id
+        for c in subsumed:
+            logging.info("subsumed %s", self.clusters[c])
+            self.parents[c] = new_cluster_id
 
-                if batch_size >= len(remaining_clusters) + len(subsumed) or len(subsumed) < len(batch):
-                    break
-                else:
-                    # no problem in case of computing closets clusters,
-                    # there will be no duplicates because that function is called again for a new batch
-                    # only if the previous batch is completely subsumed
-                    logging.warning("All batch subsumed, using new batch")
+        return subsumed
 
-            remaining_clusters.add(new_cluster_id)
+    def remove_subsumed(self, new_cluster_id, merged):
+        # returns the clusters removed because of the merge (merged ones and the ones subsumed by the new cluster)
+        if self.index is not None:
+            subsumed = self.remove_index_subsets(new_cluster_id, merged)
+            batch = self.get_batch(new_cluster_id)
+            self.update_closest_clusters(new_cluster_id, batch, check_subsumption=False, update_other=True)
+            return list(merged) + [c for c in subsumed if c not in merged]
 
-            min_dist = get_closest_cluster(new_cluster_id)
-            if min_dist:
-                heapq.heappush(heap, min_dist)
+        removed = list(merged)
+        self.parents[merged[0]] = new_cluster_id
+        self.parents[merged[1]] = new_cluster_id
 
-            if batch_size == len(flows):
-                pass
-                #assert(cost_sanity_check - overall_cost < 1e-10)
+        while True:
+            # choosing the batch to go through
+            batch = self.get_batch(new_cluster_id)
 
-            self.stats.append((len(remaining_clusters), overall_cost, time.time() - start))
-            logging.info("Cumulative cost is %s", overall_cost)
-            logging.info(self.stats[-1])
+            # now going through the batch
+            subsumed = self.update_closest_clusters(new_cluster_id, batch, check_subsumption=True, update_other=True)
 
-            self.intents.append(IncrementalIntentInfo(len(remaining_clusters), [new_cluster_id], removed))
-            if callback:
-                callback(self, remaining_clusters)
+            # remove subsumed clusters
+            self.overall_cost -= sum([self.clusters[c].cost for c in subsumed])
+            removed += subsumed
+            self.remove_remaining(subsumed)
 
-        # clustering is done
-        logging.info("Clustering is finished")
-        logging.info(">time %s", str(time.time()-start))
-        logging.info(">recounts %s", len(self.closest_clusters_recomputations))
-        # self.store_stats_csv()
-        if plot:
-            self.plot_stats(sum((x.cost for x in self.clusters[:len(flows)])))
+            for c in subsumed:
+                self.parents[c] = new_cluster_id
 
-        return [self.clusters[c] for c in remaining_clusters]
+            if self.effective_batch_size >= len(self.remaining_clusters) + len(subsumed) or len(subsumed) < len(batch):
+                break
+            else:
+                # no problem in case of computing closets clusters,
+                # there will be no duplicates because that function is called again for a new batch
+                # only if the previous batch is completely subsumed
+                logging.warning("All batch subsumed, using new batch")
+
+        return removed
+
+    def add_new_cluster(self, new_cluster_id):
+        if self.index is not None:
+            with self.metrics.phase("index_update"):
+                self.index.insert(self.clusters[new_cluster_id], new_cluster_id)
+
+        min_dist = self.get_closest_cluster(new_cluster_id)
+        if min_dist:
+            self.push_pair(min_dist)
+
+    def get_checkpoint_state(self):
+        return {
+            "clusters": self.clusters,
+            "dendrogram": self.dendrogram,
+            "remaining_clusters": self.remaining_clusters,
+            "locality_buckets": self.locality_buckets,
+            "heap": self.heap,
+            "closest_clusters": self.closest_clusters,
+            "closest_clusters_recomputations": self.closest_clusters_recomputations,
+            "overall_cost": self.overall_cost,
+            "effective_batch_size": self.effective_batch_size,
+            "flow_count": self.flow_count,
+            "index": self.index,
+            "elapsed": time.time() - self.start,
+            "random_state": random.getstate(),
+        }
+
+    def load_checkpoint_state(self, state, feature):
+        self.clusters = state["clusters"]
+        self.dendrogram = state["dendrogram"]
+        self.remaining_clusters = state["remaining_clusters"]
+        self.locality_buckets = state["locality_buckets"]
+        self.heap = state["heap"]
+        self.closest_clusters = state["closest_clusters"]
+        self.closest_clusters_recomputations = state["closest_clusters_recomputations"]
+        self.overall_cost = state["overall_cost"]
+        self.effective_batch_size = state["effective_batch_size"]
+        self.flow_count = state["flow_count"]
+        self.index = state["index"]
+        if self.index is not None:
+            self.index.feature = feature
+
+    def store_checkpoint(self, path):
+        logging.info("Storing checkpoint at k=%s in %s", len(self.remaining_clusters), path)
+        # write then rename, so that a crash while writing does not destroy the previous checkpoint
+        with open(path + ".tmp", 'wb') as f:
+            pickle.dump(self.get_checkpoint_state(), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    def checkpoint_if_needed(self):
+        if self.checkpoint_path is None:
+            return
+        if (self.checkpoint_every and len(self.intents) - self.last_checkpoint_step >= self.checkpoint_every) or \
+                (self.checkpoint_interval and time.time() - self.last_checkpoint_time >= self.checkpoint_interval):
+            self.store_checkpoint(self.checkpoint_path)
+            self.last_checkpoint_step = len(self.intents)
+            self.last_checkpoint_time = time.time()
 
     def plot_stats(self, tp):
         if plot:
@@ -270,26 +710,29 @@ class HierarchicalClustering(Clustering):
     def store_internals_pk(self, dir="./", stats=True, clusters=True, parents=True):
         if clusters:
             logging.info("Started saving clusters")
-            with open(dir + "/clusters.pk", 'w') as f:
+            with open(dir + "/clusters.pk", 'wb') as f:
                 pickle.dump(self.clusters, f)
             logging.info("Finished saving clusters")
 
-            with open(dir + "/intents.pk", 'w') as f:
-                pickle.dump(self.intents, f)
+            with open(dir + "/intents.pk", 'wb') as f:
+                pickle.dump(list(self.intents), f)
 
         if parents:
-            with open(dir + "/parents.pk", 'w') as f:
-                pickle.dump(self.parents, f)
+            with open(dir + "/parents.pk", 'wb') as f:
+                pickle.dump(list(self.parents), f)
 
         if stats:
-            with open(dir + "/stats.pk", 'w') as f:
+            with open(dir + "/stats.pk", 'wb') as f:
                 pickle.dump(self.stats, f)
 
         if stats:
-            with open(dir + "/recounts.pk", 'w') as f:
+            with open(dir + "/recounts.pk", 'wb') as f:
                 pickle.dump(self.closest_clusters_recomputations, f)
 
 
+    def store_dendrogram(self, dir="./"):
+        self.dendrogram.to_file(dir + "/dendrogram.bin")
+
     def store_cluster_hierarchy_xml(self, dir="./"):
         children = [[] for c in range(len(self.clusters))]
         roots = []
@@ -367,164 +810,117 @@ class MDSClustering(Clustering):
 
 class HierarchicalClusteringWithIndex(HierarchicalClustering):
 
-    def cluster(self, flows, feature, callback=None):
-        from .index import RTreeIndex
-        flow_labeling = feature.labeling
-
-        batch_size = self.batch_size
-        if batch_size == 0:
-            batch_size = len(flows)
-
-        self.clusters = [flow_labeling.join(flow, flow) for flow in flows]
-        self.parents = list(range(len(self.clusters)))
-        self.closest_clusters = [[]] * len(self.clusters)
-
-        logging.info("Initial clusters added")
-
-        heap = []
-        overall_cost = sum([c.cost for c in self.clusters])
-
-        start = time.time()
-
-
-        remaining_clusters = set(range(len(flows)))
-
-        index = RTreeIndex(feature)
-
-        logging.info("Indexing flows")
-
-        for i in range(len(self.clusters)):
-            index.insert(self.clusters[i], i)
-
-        logging.info("Finished indexing flows in %s seconds", time.time()-start)
-
-        def get_closest_cluster(c):
-            res = index.get_knn_approx(self.clusters[c])
-            #res = index.get_knn_precise(self.clusters[c])
-
-            if len(res) < 2:
-                assert res[0][2][1] == c
-                return None
-            elif res[0][2][1] == c:
-                return res[1][2][1]
-            else:
-                logging.warning("The first item of nearest neighbors isn't the cluster itself %s", res)
-                assert res[1][2][1] == c
-                return res[0][2][1]
-
-            # assert res[0][2][1] == c
-            # return None if len(res) < 2 else res[1][2][1]
-
+    def initial_distances(self, feature):
+        self.build_index(feature)
 
         for i in range(len(self.clusters)):
             logging.info("Adding distances for cluster %s", i)
-
-            j = get_closest_cluster(i)
-            joined = flow_labeling.join(self.clusters[i].value, self.clusters[j].value)
-            dist = cost_gain_distance(self.clusters[i], self.clusters[j], joined)
-            heapq.heappush(heap, (dist, joined, (i,j)))
-
-
-        self.stats.append((len(remaining_clusters), overall_cost, time.time() - start))
-        logging.info(self.stats[-1])
-
-        self.intents.append(IncrementalIntentInfo(len(remaining_clusters), list(remaining_clusters), []))
-        if callback:
-            callback(self, remaining_clusters)
-
-        while len(remaining_clusters) > self.cluster_count:
-            logging.info("Number of clusters so far %s", len(remaining_clusters))
-
-            removed = []
-
-            best = None
-            while True:
-
-                candidate = heapq.heappop(heap)
-                c_1, c_2 = candidate[2]
-
-                if c_1 in remaining_clusters:
-                    if c_2 in remaining_clusters:
-                        best = candidate
-                        break
-                    else:
-                        j = get_closest_cluster(c_1)
-                        joined = flow_labeling.join(self.clusters[c_1].value, self.clusters[j].value)
-                        dist = cost_gain_distance(self.clusters[c_1], self.clusters[j], joined)
-                        heapq.heappush(heap, (dist, joined, (c_1, j)))
+            self.push_pair(self.closest_cluster_entry(i))
+
+    def get_closest_cluster(self, c):
+        res = self.index.get_knn_approx(self.clusters[c])
+        #res = self.index.get_knn_precise(self.clusters[c])
+
+        if len(res) < 2:
+            assert res[0][2][1] == c
+            return None
+        elif res[0][2][1] == c:
+            return res[1][2][1]
+        else:
+            logging.warning("The first item of nearest neighbors isn't the cluster itself %s", res)
+            assert res[1][2][1] == c
+            return res[0][2][1]
+
+        # assert res[0][2][1] == c
+        # return None if len(res) < 2 else res[1][2][1]
+
+    def closest_cluster_entry(self, c):
+        j = self.get_closest_cluster(c)
+        cost = self.flow_labeling.join_cost(self.clusters[c].value, self.clusters[j].value)
+        dist = cost_gain_distance(self.clusters[c], self.clusters[j], Spec(cost, None))
+        return (dist, c, j)
+
+    def refresh_closest_cluster(self, c):
+        return self.closest_cluster_entry(c)
+
+    def remove_subsumed(self, new_cluster_id, merged):
+        return self.remove_index_subsets(new_cluster_id, merged)
+
+    def add_new_cluster(self, new_cluster_id):
+        with self.metrics.phase("index_update"):
+            self.index.insert(self.clusters[new_cluster_id], new_cluster_id)
+
+        if len(self.remaining_clusters) > 1:
+            self.push_pair(self.closest_cluster_entry(new_cluster_id))
+
+    def add_flows(self, new_flows, callback=None):
+        """
+            Adds flows to an existing clustering without re-running it.
+            A flow that is contained in a remaining cluster is placed under it and is treated as if it had been
+            subsumed when that cluster was created. The other flows become new clusters that are then merged
+            until cluster_count clusters remain.
+            The intents (and stats) are rewritten as if the new flows had been there from the beginning.
+        """
+        self.metrics.instrument(self.flow_labeling, self.flow_feature.name)
+        try:
+
+            steps = len(self.dendrogram)
+            added = {0: []}
+            removed = {}
+
+            # alive_diff[s] is the change in the number (and cost) of new flows alive from step s on
+            alive_diff = [0] * (steps + 1)
+            cost_diff = [0] * (steps + 1)
+            new_clusters = []
+
+            for flow in new_flows:
+                spec = self.flow_labeling.join(flow, flow)
+                new_id = len(self.clusters)
+                self.clusters.append(spec)
+                self.closest_clusters.append([])
+
+                containers = [c for _, c in self.index.get_supersets(spec)]
+                if containers:
+                    container = min(containers, key=lambda c: (self.clusters[c].cost, c))
+                    self.parents.append(container)
+                    step = self.dendrogram.created[container]
+                    logging.info("new flow %s placed under %s", spec, self.clusters[container])
+                    if step > 0:
+                        removed.setdefault(step, []).append(new_id)
+                        added[0].append(new_id)
+                        alive_diff[0] += 1
+                        alive_diff[step] -= 1
+                        cost_diff[0] += spec.cost
+                        cost_diff[step] -= spec.cost
                 else:
-                    if c_2 in remaining_clusters:
-                        j = get_closest_cluster(c_2)
-                        joined = flow_labeling.join(self.clusters[c_2].value, self.clusters[j].value)
-                        dist = cost_gain_distance(self.clusters[c_2], self.clusters[j], joined)
-                        heapq.heappush(heap, (dist, joined, (c_2, j)))
-
-            assert best is not None
-
-            new_cluster_id = len(self.clusters)
-            best_clusters_to_merge = best[2]
-            best_new_cluster = best[1]
-            best_distance = best[0]
-            logging.info("Final best distance is %s %s with cluster id %s by merging %s %s %s",
-                         best_distance, best_new_cluster, new_cluster_id, best_clusters_to_merge,
-                         self.clusters[best_clusters_to_merge[0]], self.clusters[best_clusters_to_merge[1]])
-
-            overall_cost += best_distance
-
-            self.clusters.append(best_new_cluster)
-            remaining_clusters -= set([best_clusters_to_merge[0], best_clusters_to_merge[1]])
-            # removed += best_clusters_to_merge # will automatically happen when removing subsumed clusters
-
-
-            self.closest_clusters.append([])
-
-            self.parents.append(new_cluster_id)
-            # self.parents[best_clusters_to_merge[0]] = new_cluster_id
-            # self.parents[best_clusters_to_merge[1]] = new_cluster_id
-
-            cost_sanity_check = self.clusters[new_cluster_id].cost
-
-            subsumed = index.get_subsets(best_new_cluster)
-            subsumed = [x[1] for x in subsumed]
-            index.remove_subset(best_new_cluster)
-
-            # remove subsumed clusters
-            overall_cost -= sum([self.clusters[c].cost for c in subsumed])
-            removed += subsumed
-            remaining_clusters -= set(subsumed)
-
-            for c in subsumed:
-                logging.info("subsumed %s", self.clusters[c])
-                self.parents[c] = new_cluster_id
-
-            min_dist = None
-
-
-            remaining_clusters.add(new_cluster_id)
-
-            index.insert(best_new_cluster, new_cluster_id)
-
-            if len(remaining_clusters) > 1:
-                j = get_closest_cluster(new_cluster_id)
-                joined = flow_labeling.join(self.clusters[new_cluster_id].value, self.clusters[j].value)
-                dist = cost_gain_distance(self.clusters[new_cluster_id], self.clusters[j], joined)
-                heapq.heappush(heap, (dist, joined, (new_cluster_id, j)))
-
-            self.stats.append((len(remaining_clusters), overall_cost, time.time() - start))
-            logging.info("Cumulative cost is %s", overall_cost)
-            logging.info(self.stats[-1])
-
-            self.intents.append(IncrementalIntentInfo(len(remaining_clusters), [new_cluster_id], removed))
-            if callback:
-                callback(self, remaining_clusters)
-
-        # clustering is done
-        logging.info("Clustering is finished")
-        logging.info(">time %s", str(time.time()-start))
-        logging.info(">recounts %s", len(self.closest_clusters_recomputations))
-        # self.store_stats_csv()
-        if plot:
-            self.plot_stats(sum((x.cost for x in self.clusters[:len(flows)])))
-
-        return [self.clusters[c] for c in remaining_clusters]
-
+                    self.parents.append(new_id)
+                    added[0].append(new_id)
+                    alive_diff[0] += 1
+                    cost_diff[0] += spec.cost
+                    new_clusters.append(new_id)
+
+            self.dendrogram.add_to_steps(added, removed)
+            alive, cost = 0, 0
+            for step in range(steps):
+                alive += alive_diff[step]
+                cost += cost_diff[step]
+                self.dendrogram.k[step] += alive
+                self.dendrogram.add_cost(step, cost)
+
+            for c in new_clusters:
+                self.add_remaining(c)
+                self.overall_cost += self.clusters[c].cost
+                with self.metrics.phase("index_update"):
+                    self.index.insert(self.clusters[c], c)
+
+            # closest clusters are computed once all new clusters are in the index
+            for c in new_clusters:
+                if len(self.remaining_clusters) > 1:
+                    self.push_pair(self.closest_cluster_entry(c))
+
+            self.flow_count += len(new_flows)
+            logging.info("Added %s flows, %s of them as new clusters", len(new_flows), len(new_clusters))
+
+            return self.merge_clusters(callback)
+        finally:
+            self.metrics.uninstrument()
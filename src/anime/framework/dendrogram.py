@@ -0,0 +1,309 @@
+__author__ = "Ali Kheradmand"
+__email__ =  "kheradm2@illinois.edu"
+
+"""
+    Compact, array-backed record of a hierarchical clustering (parents and the incremental intents log)
+"""
+
+import collections
+import numbers
+import struct
+import json
+import bisect
+from array import array
+
+IncrementalIntentInfo = collections.namedtuple('IncrementalIntentInfo', ['k', 'added', 'removed'])
+
+# clusters alive at k (and their labels, if known) and the cluster of each flow, in the order of get_flows()
+Cut = collections.namedtuple('Cut', ['k', 'clusters', 'labels', 'assignment'])
+
+
+class Dendrogram(object):
+    """
+        Step s of the log is the state after the s-th merge (step 0 is the initial clusters):
+        k[s] clusters remain, added/removed are the ids added to and removed from the remaining clusters,
+        stored CSR-style (ids of step s are ids[offsets[s]:offsets[s + 1]]).
+        Iterating over a dendrogram gives IncrementalIntentInfo entries, like the list it replaces.
+    """
+
+    magic = b"ANIMEDG2"
+
+    def __init__(self, cluster_count=0):
+        self.parents = array('q', range(cluster_count))
+
+        # per cluster: step at which it was added to / removed from the remaining clusters (-1 if never)
+        self.created = array('q')
+        self.removed_at = array('q')
+
+        # per step
+        self.k = array('q')
+        # exact: int64 while the costs are ints that fit in it, float64 once one is a float (if the ints so far are
+        # exact as floats), otherwise a list of the Python numbers (see _fit_cost)
+        self.cost = array('q')
+        self.time = array('d')
+        self.added_offsets = array('q', [0])
+        self.added_ids = array('q')
+        self.removed_offsets = array('q', [0])
+        self.removed_ids = array('q')
+
+        # see _index
+        self._index_version = None
+        self._index_cache = None
+
+    def __len__(self):
+        return len(self.k)
+
+    def __getitem__(self, step):
+        if isinstance(step, slice):
+            return [self[s] for s in range(*step.indices(len(self.k)))]
+        if step < 0:
+            step += len(self.k)
+        if not 0 <= step < len(self.k):
+            raise IndexError("step out of range")
+        return IncrementalIntentInfo(self.k[step],
+                                     self.added_ids[self.added_offsets[step]:self.added_offsets[step + 1]].tolist(),
+                                     self.removed_ids[self.removed_offsets[step]:self.removed_offsets[step + 1]].tolist())
+
+    def __iter__(self):
+        for step in range(len(self.k)):
+            yield self[step]
+
+    def _grow(self):
+        missing = len(self.parents) - len(self.created)
+        if missing > 0:
+            self.created.extend([-1] * missing)
+            self.removed_at.extend([-1] * missing)
+
+    def append_step(self, k, added, removed, cost, elapsed):
+        step = len(self.k)
+        self.k.append(k)
+        self._fit_cost(cost)
+        self.cost.append(cost)
+        self.time.append(elapsed)
+
+        self.added_ids.extend(added)
+        self.added_offsets.append(len(self.added_ids))
+        self.removed_ids.extend(removed)
+        self.removed_offsets.append(len(self.removed_ids))
+
+        self._grow()
+        for c in added:
+            self.created[c] = step
+        for c in removed:
+            self.removed_at[c] = step
+
+    def add_to_steps(self, added, removed):
+        # added, removed: dicts from step to ids to add to that step of the log (rebuilds the CSR arrays once)
+        self._grow()
+        for ids, offsets, extra, at in [(self.added_ids, self.added_offsets, added, self.created),
+                                        (self.removed_ids, self.removed_offsets, removed, self.removed_at)]:
+            new_ids = array('q')
+            new_offsets = array('q', [0])
+            for step in range(len(self.k)):
+                new_ids.extend(ids[offsets[step]:offsets[step + 1]])
+                for c in extra.get(step, []):
+                    new_ids.append(c)
+                    at[c] = step
+                new_offsets.append(len(new_ids))
+            ids[:] = new_ids
+            offsets[:] = new_offsets
+
+    def _fit_cost(self, cost):
+        # makes sure cost can be stored in self.cost without losing precision
+        if isinstance(self.cost, list):
+            return
+        if isinstance(cost, float):
+            if self.cost.typecode == 'q':
+                exact = all(abs(c) <= 1 << 53 for c in self.cost)
+                self.cost = array('d', self.cost) if exact else list(self.cost)
+        elif not isinstance(cost, numbers.Integral) or not -(1 << 63) <= cost < 1 << 63 or \
+                (self.cost.typecode == 'd' and abs(cost) > 1 << 53):
+            self.cost = list(self.cost)
+
+    def add_cost(self, step, cost):
+        cost = self.cost[step] + cost
+        self._fit_cost(cost)
+        self.cost[step] = cost
+
+    def get_stats(self, step):
+        return self.k[step], self.cost[step], self.time[step]
+
+    def iter_stats(self):
+        for step in range(len(self.k)):
+            yield self.get_stats(step)
+
+    def get_step(self, k):
+        # the last step with at least k remaining clusters (k is decreasing along the log)
+        lo, hi = 0, len(self.k)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.k[mid] >= k:
+                lo = mid + 1
+            else:
+                hi = mid
+        assert lo > 0, "no step with at least %s clusters" % k
+        return lo - 1
+
+    def is_alive_at_step(self, c, step):
+        return self.created[c] != -1 and self.created[c] <= step and \
+            (self.removed_at[c] == -1 or self.removed_at[c] > step)
+
+    def is_alive(self, c, k):
+        return self.is_alive_at_step(c, self.get_step(k))
+
+    def get_alive(self, k):
+        """
+            Clusters alive at k, sorted: clusters are kept ordered by the step that removes them, so the ones still
+            there at the step of k are a suffix found by binary search. The suffix also holds the clusters created
+            after that step, which are at most as many as the merges left (fewer than k), so a query takes
+            O(log n + k log k) rather than a scan of all the clusters.
+        """
+        step = self.get_step(k)
+        order, deaths = self._index()[:2]
+        start = bisect.bisect_right(deaths, step)
+        return sorted(c for c in order[start:] if self.created[c] <= step)
+
+    def get_ancestor(self, c, k):
+        """
+            The cluster that represents c when k clusters remain. Steps that remove clusters only grow along the
+            parents, so the first ancestor not yet removed at the step of k is found with jump pointers (each node
+            points to its parent or to an ancestor further up, in a skew-binary pattern): O(log depth) per query
+            with O(n) extra memory.
+        """
+        step = self.get_step(k)
+        jump = self._index()[2]
+
+        def alive(x):
+            return self.created[x] != -1 and (self.removed_at[x] == -1 or self.removed_at[x] > step)
+
+        while not alive(c):
+            assert self.parents[c] != c, "%s has no ancestor alive at k=%s" % (c, k)
+            c = jump[c] if not alive(jump[c]) else self.parents[c]
+        assert self.created[c] <= step, "%s has no ancestor alive at k=%s" % (c, k)
+        return c
+
+    def _index(self):
+        # (clusters by removal step, their removal steps, jump pointers), rebuilt after the dendrogram changes
+        self._grow()
+        version = (len(self.k), len(self.parents), len(self.added_ids), len(self.removed_ids))
+        if self._index_version != version:
+            never = 1 << 62
+            order = sorted((c for c in range(len(self.created)) if self.created[c] != -1),
+                           key=lambda c: never if self.removed_at[c] == -1 else self.removed_at[c])
+            deaths = array('q', [never if self.removed_at[c] == -1 else self.removed_at[c] for c in order])
+            self._index_cache = (array('q', order), deaths, self._jumps())
+            self._index_version = version
+        return self._index_cache
+
+    def _jumps(self):
+        # jump pointers of every cluster, parents before children (ids are not ordered when flows are added later)
+        n = len(self.parents)
+        depth = array('q', [-1]) * n
+        jump = array('q', range(n))
+        for c in range(n):
+            path = []
+            x = c
+            while depth[x] == -1:
+                path.append(x)
+                if self.parents[x] == x:
+                    break
+                x = self.parents[x]
+            for y in reversed(path):
+                p = self.parents[y]
+                if p == y:
+                    depth[y] = 0
+                    continue
+                depth[y] = depth[p] + 1
+                jp = jump[p]
+                jump[y] = jump[jp] if depth[p] - depth[jp] == depth[jp] - depth[jump[jp]] else p
+        return jump
+
+    def get_flows(self):
+        # initial clusters, and flows placed directly under an existing cluster (never in the log)
+        self._grow()
+        return [c for c in range(len(self.created)) if self.created[c] <= 0]
+
+    def cut(self, k, labels=None):
+        return self.cuts([k], labels)[0]
+
+    def cuts(self, ks, labels=None):
+        """
+            Cuts the dendrogram at each k in ks with a single sweep over the log, keeping for each cluster a
+            union-find link to the cluster that removed it.
+            labels (e.g. the clusters of the clustering) is used to fill in the labels of the cut if given.
+        """
+        self._grow()
+        flows = self.get_flows()
+
+        links = array('q', range(len(self.parents)))
+
+        def find(c):
+            root = c
+            while links[root] != root:
+                root = links[root]
+            while links[c] != root:
+                links[c], c = root, links[c]
+            return root
+
+        for f in flows:
+            if self.created[f] == -1:
+                links[f] = self.parents[f]
+
+        alive = set()
+        res = {}
+        step = -1
+        for k in sorted(set(ks), reverse=True):
+            target = self.get_step(k)
+            while step < target:
+                step += 1
+                alive.update(self.added_ids[self.added_offsets[step]:self.added_offsets[step + 1]])
+                for c in self.removed_ids[self.removed_offsets[step]:self.removed_offsets[step + 1]]:
+                    alive.discard(c)
+                    links[c] = self.parents[c]
+
+            clusters = sorted(alive)
+            res[k] = Cut(k, clusters, [labels[c] for c in clusters] if labels is not None else None,
+                         array('q', [find(f) for f in flows]))
+
+        return [res[k] for k in ks]
+
+    def _arrays(self):
+        return [self.parents, self.created, self.removed_at, self.k, self.cost, self.time,
+                self.added_offsets, self.added_ids, self.removed_offsets, self.removed_ids]
+
+    def to_file(self, filename):
+        # native byte order, as written by array.tofile; the costs are preceded by their typecode ('o' for a list,
+        # written as json)
+        self._grow()
+        with open(filename, 'wb') as f:
+            f.write(Dendrogram.magic)
+            arrays = self._arrays()
+            f.write(struct.pack("<%dq" % len(arrays), *[len(a) for a in arrays]))
+            for a in arrays:
+                if a is self.cost:
+                    f.write(b"o" if isinstance(a, list) else a.typecode.encode())
+                if isinstance(a, list):
+                    data = json.dumps(a).encode()
+                    f.write(struct.pack("<q", len(data)))
+                    f.write(data)
+                else:
+                    a.tofile(f)
+
+    @classmethod
+    def from_file(cls, filename):
+        dendrogram = cls()
+        with open(filename, 'rb') as f:
+            assert f.read(len(Dendrogram.magic)) == Dendrogram.magic, "%s is not a dendrogram file" % filename
+            arrays = dendrogram._arrays()
+            lengths = struct.unpack("<%dq" % len(arrays), f.read(8 * len(arrays)))
+            for a, l in zip(arrays, lengths):
+                if a is dendrogram.cost:
+                    typecode = f.read(1).decode()
+                    if typecode == "o":
+                        size, = struct.unpack("<q", f.read(8))
+                        dendrogram.cost = json.loads(f.read(size).decode())
+                        continue
+                    a = dendrogram.cost = array(typecode)
+                del a[:]
+                a.fromfile(f, l)
+        return dendrogram
@@ -44,11 +44,30 @@ class HRegex(object):
 
 
 class HRegexLabeling(Labeling):
+    # a graph search per join
+    join_expense = 100
+
     def __init__(self, labeling, d = 1):
         self.labeling = labeling
         self.d = d
 
+    def locality_keys(self, l):
+        # paths with similar first and last hops
+        first = self.labeling.locality_keys(l.regex[0].label)
+        last = self.labeling.locality_keys(l.regex[-1].label)
+        return [("first", key) for key in first] + [("last", key) for key in last]
+
     def join(self, l1, l2):
+        return self._join(l1, l2)
+
+    def join_bounded(self, l1, l2, max_cost):
+        return self._join(l1, l2, max_cost)
+
+    def join_cost_bounded(self, l1, l2, max_cost):
+        spec = self._join(l1, l2, max_cost)
+        return spec.cost if spec is not None else None
+
+    def _join(self, l1, l2, max_cost=None):
         #print l1, l2
 
         class Entry(object):
@@ -81,10 +100,21 @@ class HRegexLabeling(Labeling):
         heapify(q)
         closed = {}
         best = None
+
+        def final_cost(node):
+            # cost of the regex of a final node: geometric mean of the label costs (to the power d)
+            return (closed[node][0] ** (-1.0 / node[0])) ** self.d
+
         while q:
             est, node, parent, cost = heappop(q)
             if node in closed:
                 continue
+            if max_cost is not None and est ** (float(self.d) / N) > max_cost:
+                # nodes come out by increasing cost and a regex has at most N labels, so every regex from here on
+                # costs more than max_cost; the best one so far is the result if it is within the bound
+                if best is not None and final_cost(best) <= max_cost:
+                    return self.get_regex(best, closed)
+                return None
             closed[node] = (cost, parent)
             #print "at", "{} ({})".format(est,cost), node, parent
             n, i, j, i_m, j_m, l_m, l = node
@@ -105,31 +135,9 @@ class HRegexLabeling(Labeling):
                 if -n < N:
                     continue
 
-                node = best
-                best_cost, parent = closed[node]
-                #print "best is {} ({}) {} {}".format(best_cost, best_cost ** (-1.0/node[0]), node, parent)
-
-                ret = []
-                c = 0
-                while node is not None:
-                    #print "--", cost, node
-                    _, _, _, i_m, j_m, l_m, l = node
-                    c += 1
-
-                    if l_m == 0 and parent is None or parent[0] != node[0]:
-                        m = c > 2 or i_m or j_m
-                        #print "adding next label", l, c > 2, i_m, j_m,"=>", m
-                        ret.append(HRegexElement(l, m))
-                        c = 0
-
-                    node = parent
-                    if node:
-                        cost, parent = closed[node]
-
-                ret.reverse()
-                print(best_cost, best_cost**(-1.0/best[0]))
-                ret = Spec((best_cost**(-1.0/best[0]))**self.d, HRegex(ret))
-                #print ret
+                ret = self.get_regex(best, closed)
+                if max_cost is not None and ret.cost > max_cost:
+                    return None
                 return ret
 
             else:
@@ -224,4 +232,31 @@ class HRegexLabeling(Labeling):
 
         assert False
 
+    def get_regex(self, best, closed):
+        # walks back from the final node best of a join search
+        node = best
+        best_cost, parent = closed[node]
+        #print "best is {} ({}) {} {}".format(best_cost, best_cost ** (-1.0/node[0]), node, parent)
+
+        ret = []
+        c = 0
+        while node is not None:
+            #print "--", cost, node
+            _, _, _, i_m, j_m, l_m, l = node
+            c += 1
+
+            if l_m == 0 and parent is None or parent[0] != node[0]:
+                m = c > 2 or i_m or j_m
+                #print "adding next label", l, c > 2, i_m, j_m,"=>", m
+                ret.append(HRegexElement(l, m))
+                c = 0
+
+            node = parent
+            if node:
+                cost, parent = closed[node]
+
+        ret.reverse()
+        #print best_cost, best_cost**(-1.0/best[0])
+        return Spec((best_cost**(-1.0/best[0]))**self.d, HRegex(ret))
+
 
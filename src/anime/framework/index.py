@@ -5,6 +5,7 @@ __email__ =  "kheradm2@illinois.edu"
     Various indexing techniques
 """
 
+import math
 import heapq
 from .labeling import Spec
 
@@ -16,11 +17,16 @@ class Index(object):
     def get_subsets(self, key):
         assert False
 
+    def get_supersets(self, key):
+        assert False
+
     def remove_subset(self, key):
         assert False
 
 
-class RtreeIndexNode:
+class RtreeIndexNode(object):
+    __slots__ = ["is_leaf", "bounding_box", "objects", "covered_approx"]
+
     def __init__(self, bounding_box):
         self.is_leaf = True
         self.bounding_box = bounding_box
@@ -63,19 +69,36 @@ class RTreeIndex(Index):
 
 
     def _sanity_check(self, n):
-        for o in n.objects:
-                b = isinstance(o, RtreeIndexNode)
-                assert not b if n.is_leaf else b
-        if n != self.root:
-            bb = RTreeIndex.obj_bb(n.objects[0])
-            for o in n.objects[1:]:
-                bb = self.feature.labeling.join(bb.value, RTreeIndex.obj_bb(o).value)
-            assert bb == n.bounding_box
-        if not n.is_leaf:
+        for n in self._iter_nodes(n):
             for o in n.objects:
-                self._sanity_check(o)
+                    b = isinstance(o, RtreeIndexNode)
+                    assert not b if n.is_leaf else b
+            if n != self.root:
+                bb = RTreeIndex.obj_bb(n.objects[0])
+                for o in n.objects[1:]:
+                    bb = self.feature.labeling.join(bb.value, RTreeIndex.obj_bb(o).value)
+                assert bb == n.bounding_box
+
+    def _iter_nodes(self, n):
+        # nodes under n (n included) in depth first pre-order, on an explicit stack
+        stack = [n]
+        while stack:
+            n = stack.pop()
+            yield n
+            if not n.is_leaf:
+                stack.extend(reversed(n.objects))
 
     def _remove_subset(self, key, n):
+        # the recursive calls of _remove_subset_node (yielded nodes) run on an explicit stack, in the same order
+        stack = [self._remove_subset_node(key, n)]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+            else:
+                stack.append(self._remove_subset_node(key, child))
+
+    def _remove_subset_node(self, key, n):
         if self.feature.labeling.subset(n.bounding_box.value, key.value):
             n.covered_approx = 0
             n.objects = []
@@ -91,7 +114,7 @@ class RTreeIndex(Index):
                 for i in range(len(n.objects)):
                     if self.feature.labeling.meet(RTreeIndex.internal_obj_get_bb(n.objects[i]).value, key.value):
                         n.covered_approx -= n.objects[i].covered_approx
-                        self._remove_subset(key, n.objects[i])
+                        yield n.objects[i]
                         n.covered_approx += n.objects[i].covered_approx
                 n.objects = [o for o in n.objects if len(o.objects) > 0]
 
@@ -189,15 +212,14 @@ class RTreeIndex(Index):
             return np
 
     def print_index(self, n=None, level=0, level_limit=0):
-        if 0 < level_limit < level:
-            return
-        if n is None:
-            self.print_index(self.root, level_limit=level_limit)
-        else:
+        stack = [(self.root if n is None else n, level)]
+        while stack:
+            n, level = stack.pop()
+            if 0 < level_limit < level:
+                continue
             print('--' * level, n.bounding_box, n.covered_approx)
             if not n.is_leaf:
-                for o in n.objects:
-                    self.print_index(o, level+1, level_limit)
+                stack.extend((o, level + 1) for o in reversed(n.objects))
             else:
                 for o in n.objects:
                     print('--' * (level+1), o)
@@ -219,42 +241,53 @@ class RTreeIndex(Index):
 
 
     def _insert(self, key, value, n):
-        n.bounding_box = self.feature.labeling.join(n.bounding_box.value, key.value)
-        n.covered_approx += key.cost # assumption: no overlap between entries
-
-        if n.is_leaf:
-            n.objects.append((key,value)) # assumption: key is unique
-            return self.split_node(n)
-        else:
-            l = len(n.objects)
-            best = None
-            for i in range(l):
-                spec = self.feature.labeling.join(n.objects[i].bounding_box.value, key.value)
-                diff = spec.cost - n.objects[i].bounding_box.cost
-                if best is None or diff < best[0] or (abs(diff - best[0]) < 1e-10 and spec.cost < best[1].cost):
-                    best = (diff, spec, i)
-
-            assert best is not None
-            # print "best is", best
-
-            new_child = self._insert(key, value, n.objects[best[2]])
+        # down to a leaf, then back up the path splitting the nodes that overflow
+        path = []
+        while True:
+            n.bounding_box = self.feature.labeling.join(n.bounding_box.value, key.value)
+            n.covered_approx += key.cost # assumption: no overlap between entries
 
+            if n.is_leaf:
+                n.objects.append((key,value)) # assumption: key is unique
+                break
+            best = self._choose_subtree(key, n)
+            path.append((n, best))
+            n = n.objects[best]
+
+        new_child = self.split_node(n)
+        for n, best in reversed(path):
             if new_child:
-                n.objects.insert(best[2] + 1, new_child)
+                n.objects.insert(best + 1, new_child)
+            new_child = self.split_node(n)
+        return new_child
+
+    def _choose_subtree(self, key, n):
+        # child of n whose bounding box grows the least with key (then the smallest one)
+        l = len(n.objects)
+        best = None
+        for i in range(l):
+            if best is None:
+                spec = self.feature.labeling.join(n.objects[i].bounding_box.value, key.value)
+            else:
+                # children that would grow more than the best one so far (ties included) are not joined in full;
+                # int costs are compared exactly, floats with some slack
+                max_cost = best[0] + n.objects[i].bounding_box.cost
+                if isinstance(max_cost, float):
+                    max_cost += 1e-10
+                spec = self.feature.labeling.join_bounded(n.objects[i].bounding_box.value, key.value, max_cost)
+                if spec is None:
+                    continue
+            diff = spec.cost - n.objects[i].bounding_box.cost
+            if best is None or diff < best[0] or (abs(diff - best[0]) < 1e-10 and spec.cost < best[1].cost):
+                best = (diff, spec, i)
 
-            return self.split_node(n)
+        assert best is not None
+        # print "best is", best
+        return best[2]
 
 
     def get_all_nodes(self):
-        acc = []
-        self._get_all_nodes(self.root, acc)
-        return acc
-
-    def _get_all_nodes(self, n, acc):
-        acc.append(n)
-        if not n.is_leaf:
-            for o in n.objects:
-                self._get_all_nodes(o, acc)
+        return list(self._iter_nodes(self.root))
 
 
 
@@ -264,15 +297,62 @@ class RTreeIndex(Index):
         return acc
 
     def _get_subsets(self, key, n, acc):
-        # print "in get_subset for", key, n.bounding_box
-        if n.is_leaf:
-            for o in n.objects:
-                if self.feature.labeling.subset(RTreeIndex.leaf_obj_get_bb(o).value, key.value):
-                    acc.append(o)
-        else:
+        stack = [n]
+        while stack:
+            n = stack.pop()
+            if n.is_leaf:
+                for o in n.objects:
+                    if self.feature.labeling.subset(RTreeIndex.leaf_obj_get_bb(o).value, key.value):
+                        acc.append(o)
+            else:
+                # pushed in reverse, so that entries are found in the same (depth first) order as before
+                stack.extend([o for o in n.objects
+                              if self.feature.labeling.meet(RTreeIndex.internal_obj_get_bb(o).value, key.value)][::-1])
+
+    def get_depth(self):
+        # insertions keep all leaves at the same depth, so following the first child is enough
+        depth = 1
+        n = self.root
+        while not n.is_leaf and len(n.objects) > 0:
+            n = n.objects[0]
+            depth += 1
+        return depth
+
+    def get_stats(self):
+        nodes = self.get_all_nodes()
+        leaves = [n for n in nodes if n.is_leaf]
+        return {"depth": self.get_depth(), "nodes": len(nodes), "leaves": len(leaves),
+                "entries": sum(len(n.objects) for n in leaves)}
+
+    def get_leaf_neighbors(self, key):
+        # entries of the first leaf found whose bounding box contains key (e.g. the leaf of key itself)
+        n = self.root
+        while not n.is_leaf:
             for o in n.objects:
-                if self.feature.labeling.meet(RTreeIndex.internal_obj_get_bb(o).value, key.value):
-                    self._get_subsets(key, o, acc)
+                if self.feature.labeling.subset(key.value, o.bounding_box.value):
+                    n = o
+                    break
+            else:
+                return []
+        return list(n.objects)
+
+    def get_supersets(self, key):
+        acc = []
+        self._get_supersets(key, self.root, acc)
+        return acc
+
+    def _get_supersets(self, key, n, acc):
+        # an entry can contain key only if the bounding box of every node on its path contains key
+        stack = [n]
+        while stack:
+            n = stack.pop()
+            if n.is_leaf:
+                for o in n.objects:
+                    if self.feature.labeling.subset(key.value, RTreeIndex.leaf_obj_get_bb(o).value):
+                        acc.append(o)
+            else:
+                stack.extend([o for o in n.objects
+                              if self.feature.labeling.subset(key.value, RTreeIndex.internal_obj_get_bb(o).value)][::-1])
 
 
     # def compute_node_cover_cost(self, n =None):
@@ -314,13 +394,11 @@ class RTreeIndex(Index):
         return acc
 
     def _get_all_bounding_boxes(self, n, acc):
-        acc.append(n.bounding_box)
-        if n.is_leaf:
-            for o in n.objects:
-                acc.append(RTreeIndex.leaf_obj_get_bb(o))
-        else:
-            for o in n.objects:
-                self._get_all_bounding_boxes(o, acc)
+        for n in self._iter_nodes(n):
+            acc.append(n.bounding_box)
+            if n.is_leaf:
+                for o in n.objects:
+                    acc.append(RTreeIndex.leaf_obj_get_bb(o))
 
     @staticmethod
     def get_bb(n, o):
@@ -331,25 +409,43 @@ class RTreeIndex(Index):
 
     def get_knn_approx(self, key, k=2):
         heap = []
+        # sequence number right after the distance, so that ties are broken by insertion order (which only depends
+        # on the tree) and never fall through to comparing labels or nodes
+        seq = 0
         joined = self.feature.labeling.join(self.root.bounding_box.value, key.value)
         dist = joined.cost - self.root.bounding_box.cost - key.cost
-        entry = (dist, joined, self.root) # costdiff, joined, obj
+        entry = (dist, seq, joined, self.root) # costdiff, seq, joined, obj
         heapq.heappush(heap, entry)
         ret = []
+        # (negated) distances of the k closest entries pushed so far: an entry farther than all of them would be
+        # popped after them, so it is never returned and does not need to be joined in full
+        closest = []
         while len(heap) > 0 and len(ret) < k:
             entry = heapq.heappop(heap)
-            dist, joined, obj = entry
+            dist, _, joined, obj = entry
             #print dist, joined, obj, len(heap), len(ret)
 
             if isinstance(obj, RtreeIndexNode):
                 for o in obj.objects:
                     bb = RTreeIndex.get_bb(obj, o)
-                    joined = self.feature.labeling.join(bb.value, key.value)
+                    if obj.is_leaf and len(closest) == k:
+                        joined = self.feature.labeling.join_bounded(bb.value, key.value,
+                                                                    -closest[0] + bb.cost + key.cost)
+                        if joined is None:
+                            continue
+                    else:
+                        joined = self.feature.labeling.join(bb.value, key.value)
                     dist = joined.cost - bb.cost - key.cost
-                    heapq.heappush(heap, (dist, joined, o))
+                    if obj.is_leaf:
+                        if len(closest) < k:
+                            heapq.heappush(closest, -dist)
+                        elif dist < -closest[0]:
+                            heapq.heapreplace(closest, -dist)
+                    seq += 1
+                    heapq.heappush(heap, (dist, seq, joined, o))
             else:
                 # ret.append(obj)
-                ret.append(entry)
+                ret.append((dist, joined, obj))
 
 
         return ret
@@ -371,6 +467,326 @@ class RTreeIndex(Index):
 
 
 
+class TupleIndexNode(object):
+    __slots__ = ["is_leaf", "objects", "boxes", "box", "max_cost", "covered_approx"]
+
+    def __init__(self, is_leaf=True):
+        self.is_leaf = is_leaf
+        # (key, value) entries and their boxes in leaves, child nodes otherwise
+        self.objects = []
+        self.boxes = []
+        # box of everything under the node (None when empty), largest entry cost and sum of entry costs under it
+        self.box = None
+        self.max_cost = 0
+        self.covered_approx = 0
+
+
+class TupleIndex(Index):
+    """
+        R-tree over per-feature intervals (see Labeling.interval) instead of joined labels: every feature of a tuple
+        label that has an embedding is a dimension of the boxes (IPv4 ranges, DFS intervals of DAG labels, numbered
+        DValues), so splits, subtree choices and pruning look at each feature on its own.
+        Boxes only narrow down the candidates; entries are always checked with the labeling itself.
+        A labeling that is not a tuple is indexed as a single feature.
+    """
+
+    def __init__(self, feature, node_min_size=2, node_max_size=8):
+        self.feature = feature
+        features = getattr(feature.labeling, "features", None)
+        self.is_tuple = features is not None
+        self.labelings = [f.labeling for f in features] if self.is_tuple else [feature.labeling]
+        self.node_min_size = node_min_size
+        self.node_max_size = node_max_size
+        self.root = TupleIndexNode()
+
+    def get_values(self, key):
+        return key.value if self.is_tuple else (key.value,)
+
+    def get_box(self, key):
+        # [lo, hi] per feature, None for features without an embedding (never used for pruning)
+        return [labeling.interval(v) for labeling, v in zip(self.labelings, self.get_values(key))]
+
+    @staticmethod
+    def box_union(a, b):
+        if a is None:
+            return list(b)
+        return [None if x is None else (min(x[0], y[0]), max(x[1], y[1])) for x, y in zip(a, b)]
+
+    @staticmethod
+    def box_volume(box):
+        # log scale, so that no feature dominates just because of the size of its domain
+        return sum(math.log1p(x[1] - x[0]) for x in box if x is not None)
+
+    @staticmethod
+    def box_contains(outer, inner):
+        return all(x is None or (x[0] <= y[0] and y[1] <= x[1]) for x, y in zip(outer, inner))
+
+    @staticmethod
+    def box_intersects(a, b):
+        return all(x is None or (x[0] <= y[1] and y[0] <= x[1]) for x, y in zip(a, b))
+
+    @staticmethod
+    def enlargement(box, other):
+        return TupleIndex.box_volume(TupleIndex.box_union(box, other)) - TupleIndex.box_volume(box)
+
+    @staticmethod
+    def child_boxes(n):
+        return n.boxes if n.is_leaf else [o.box for o in n.objects]
+
+    def update(self, n):
+        n.box = None
+        for box in TupleIndex.child_boxes(n):
+            n.box = TupleIndex.box_union(n.box, box)
+        if n.is_leaf:
+            n.max_cost = max([key.cost for key, _ in n.objects] or [0])
+            n.covered_approx = sum(key.cost for key, _ in n.objects)
+        else:
+            n.max_cost = max([o.max_cost for o in n.objects] or [0])
+            n.covered_approx = sum(o.covered_approx for o in n.objects)
+
+    def insert(self, key, value):
+        new_child = self._insert(key, value, self.get_box(key), self.root)
+        if new_child:
+            new_root = TupleIndexNode(is_leaf=False)
+            new_root.objects = [self.root, new_child]
+            self.update(new_root)
+            self.root = new_root
+
+    def _insert(self, key, value, box, n):
+        path = []
+        while not n.is_leaf:
+            # smallest enlargement, then smallest box
+            best = min(range(len(n.objects)), key=lambda i: (TupleIndex.enlargement(n.objects[i].box, box),
+                                                             TupleIndex.box_volume(n.objects[i].box), i))
+            path.append((n, best))
+            n = n.objects[best]
+        n.objects.append((key, value))
+        n.boxes.append(box)
+
+        self.update(n)
+        new_child = self.split_node(n)
+        for n, best in reversed(path):
+            if new_child:
+                n.objects.insert(best + 1, new_child)
+            self.update(n)
+            new_child = self.split_node(n)
+        return new_child
+
+    def split_node(self, n):
+        if len(n.objects) <= self.node_max_size:
+            return None
+
+        # quadratic split: the two entries that waste the most space together go to different groups
+        boxes = TupleIndex.child_boxes(n)
+        l = len(boxes)
+        seeds = max(((i, j) for i in range(l) for j in range(i + 1, l)),
+                    key=lambda p: TupleIndex.box_volume(TupleIndex.box_union(boxes[p[0]], boxes[p[1]])) -
+                    TupleIndex.box_volume(boxes[p[0]]) - TupleIndex.box_volume(boxes[p[1]]))
+        groups = [[seeds[0]], [seeds[1]]]
+        group_boxes = [boxes[seeds[0]], boxes[seeds[1]]]
+        rest = [i for i in range(l) if i not in seeds]
+        for r, i in enumerate(rest):
+            left = len(rest) - r
+            if len(groups[0]) + left <= self.node_min_size:
+                g = 0
+            elif len(groups[1]) + left <= self.node_min_size:
+                g = 1
+            else:
+                g = min([0, 1], key=lambda g: (TupleIndex.enlargement(group_boxes[g], boxes[i]),
+                                               TupleIndex.box_volume(group_boxes[g]), len(groups[g])))
+            groups[g].append(i)
+            group_boxes[g] = TupleIndex.box_union(group_boxes[g], boxes[i])
+
+        new_node = TupleIndexNode(n.is_leaf)
+        objects = n.objects
+        n.objects = [objects[i] for i in groups[0]]
+        new_node.objects = [objects[i] for i in groups[1]]
+        if n.is_leaf:
+            n.boxes = [boxes[i] for i in groups[0]]
+            new_node.boxes = [boxes[i] for i in groups[1]]
+        self.update(n)
+        self.update(new_node)
+        return new_node
+
+    def get_subsets(self, key):
+        acc = []
+        self._get_subsets(key, self.get_box(key), self.root, acc)
+        return acc
+
+    def _get_subsets(self, key, box, n, acc):
+        # an entry within key has its box within the box of key, so it is under nodes that intersect it
+        stack = [n]
+        while stack:
+            n = stack.pop()
+            if n.box is None or not TupleIndex.box_intersects(n.box, box):
+                continue
+            if n.is_leaf:
+                for o, b in zip(n.objects, n.boxes):
+                    if TupleIndex.box_contains(box, b) and self.feature.labeling.subset(o[0].value, key.value):
+                        acc.append(o)
+            else:
+                stack.extend(reversed(n.objects))
+
+    def get_supersets(self, key):
+        acc = []
+        self._get_supersets(key, self.get_box(key), self.root, acc)
+        return acc
+
+    def _get_supersets(self, key, box, n, acc):
+        stack = [n]
+        while stack:
+            n = stack.pop()
+            if n.box is None or not TupleIndex.box_contains(n.box, box):
+                continue
+            if n.is_leaf:
+                for o, b in zip(n.objects, n.boxes):
+                    if TupleIndex.box_contains(b, box) and self.feature.labeling.subset(key.value, o[0].value):
+                        acc.append(o)
+            else:
+                stack.extend(reversed(n.objects))
+
+    def remove_subset(self, key):
+        # returns the cost of the removed entries
+        removed = self._remove_subset(key, self.get_box(key), self.root)
+        while not self.root.is_leaf and len(self.root.objects) == 1:
+            self.root = self.root.objects[0]
+        if not self.root.is_leaf and len(self.root.objects) == 0:
+            self.root = TupleIndexNode()
+        return removed
+
+    def _remove_subset(self, key, box, n):
+        # nodes that intersect the box of key, children after their parents; updated in the reverse order
+        visited = []
+        stack = [n]
+        while stack:
+            n = stack.pop()
+            if n.box is None or not TupleIndex.box_intersects(n.box, box):
+                continue
+            visited.append(n)
+            if not n.is_leaf:
+                stack.extend(n.objects)
+
+        removed = 0
+        for n in reversed(visited):
+            if n.is_leaf:
+                kept = [(o, b) for o, b in zip(n.objects, n.boxes)
+                        if not (TupleIndex.box_contains(box, b) and self.feature.labeling.subset(o[0].value, key.value))]
+                removed += n.covered_approx - sum(o[0].cost for o, _ in kept)
+                n.objects = [o for o, _ in kept]
+                n.boxes = [b for _, b in kept]
+            else:
+                n.objects = [o for o in n.objects if len(o.objects) > 0]
+            self.update(n)
+        return removed
+
+    def join_cost_lower_bound(self, values, n):
+        # of the join of key (given by its feature values) with any entry under n; 1 for features without embedding
+        cost = 1
+        for labeling, v, b in zip(self.labelings, values, n.box):
+            if b is not None:
+                cost *= labeling.join_cost_lower_bound(v, b[0], b[1])
+        return cost
+
+    def get_knn_approx(self, key, k=2):
+        """
+            Best first search with lower bounds of the distance for nodes: the join costs at least the product of
+            the per-feature lower bounds and at least the cost of the entry (so the result is exact).
+            Same result format as RTreeIndex: (distance, joined, (key, value)) for the k closest entries.
+        """
+        if self.root.box is None:
+            return []
+        values = self.get_values(key)
+
+        def lower_bound(n):
+            return max(self.join_cost_lower_bound(values, n) - n.max_cost, 0) - key.cost
+
+        seq = 0
+        heap = [(lower_bound(self.root), seq, None, self.root)]
+        # (negated) distances of the k closest entries pushed so far, anything farther is never returned
+        closest = []
+        ret = []
+        while len(heap) > 0 and len(ret) < k:
+            dist, _, joined, obj = heapq.heappop(heap)
+            if not isinstance(obj, TupleIndexNode):
+                ret.append((dist, joined, obj))
+            elif obj.is_leaf:
+                for o in obj.objects:
+                    if len(closest) == k:
+                        joined = self.feature.labeling.join_bounded(o[0].value, key.value,
+                                                                    -closest[0] + o[0].cost + key.cost)
+                        if joined is None:
+                            continue
+                    else:
+                        joined = self.feature.labeling.join(o[0].value, key.value)
+                    dist = joined.cost - o[0].cost - key.cost
+                    if len(closest) < k:
+                        heapq.heappush(closest, -dist)
+                    elif dist < -closest[0]:
+                        heapq.heapreplace(closest, -dist)
+                    seq += 1
+                    heapq.heappush(heap, (dist, seq, joined, o))
+            else:
+                for o in obj.objects:
+                    bound = lower_bound(o)
+                    if len(closest) == k and bound > -closest[0]:
+                        continue
+                    seq += 1
+                    heapq.heappush(heap, (bound, seq, None, o))
+
+        return ret
+
+    def get_leaf_neighbors(self, key):
+        # entries of the first leaf found whose box contains the box of key
+        box = self.get_box(key)
+        n = self.root
+        while not n.is_leaf:
+            for o in n.objects:
+                if TupleIndex.box_contains(o.box, box):
+                    n = o
+                    break
+            else:
+                return []
+        return list(n.objects)
+
+    def get_all_nodes(self):
+        acc = []
+        stack = [self.root]
+        while stack:
+            n = stack.pop()
+            acc.append(n)
+            if not n.is_leaf:
+                stack.extend(n.objects)
+        return acc
+
+    def get_depth(self):
+        depth = 1
+        n = self.root
+        while not n.is_leaf and len(n.objects) > 0:
+            n = n.objects[0]
+            depth += 1
+        return depth
+
+    def get_stats(self):
+        nodes = self.get_all_nodes()
+        leaves = [n for n in nodes if n.is_leaf]
+        return {"depth": self.get_depth(), "nodes": len(nodes), "leaves": len(leaves),
+                "entries": sum(len(n.objects) for n in leaves)}
+
+    def print_index(self, n=None, level=0):
+        stack = [(self.root if n is None else n, level)]
+        while stack:
+            n, level = stack.pop()
+            print('--' * level, n.box, n.covered_approx)
+            if n.is_leaf:
+                for o in n.objects:
+                    print('--' * (level + 1), o)
+            else:
+                stack.extend((o, level + 1) for o in reversed(n.objects))
+
+
+
+
+
 import unittest
 
 
@@ -407,3 +823,94 @@ class TestIndex(unittest.TestCase):
         self.assertEqual(cover_dec, 252)
 
         index.print_index()
+
+    def test_choose_subtree_exact(self):
+        from .labeling import Feature, Spec, HierarchicalLabeling
+
+        # a1 is in both A and B, which grow the same with it: the smaller one (B) is chosen, even though the
+        # costs are beyond what a float holds exactly
+        label_info = {"Any": {"parents": [], "cost": 1 << 62}, "A": {"parents": ["Any"], "cost": (1 << 60) + 3},
+                      "B": {"parents": ["Any"], "cost": (1 << 60) + 1}, "a1": {"parents": ["A", "B"], "cost": 1}}
+        labeling = HierarchicalLabeling(label_info)
+        index = RTreeIndex(Feature('host', labeling))
+        n = RtreeIndexNode(Spec(labeling.cost("Any"), "Any"))
+        n.objects = [RtreeIndexNode(Spec(labeling.cost(l), l)) for l in ["A", "B"]]
+        self.assertEqual(index._choose_subtree(Spec(1, "a1"), n), 1)
+
+    def test_tuple_index(self):
+        import random
+        from .labeling import Feature, Spec, TupleLabeling, DValueLabeling, HierarchicalLabeling
+        from .ip_labeling import IPv4PrefixLabeling, IPv4Prefix
+
+        label_info = {"Any": {"parents": [], "cost": 4}, "A": {"parents": ["Any"], "cost": 2},
+                      "B": {"parents": ["Any"], "cost": 2}, "a1": {"parents": ["A"], "cost": 1},
+                      "a2": {"parents": ["A"], "cost": 1}, "b1": {"parents": ["B"], "cost": 1},
+                      "b2": {"parents": ["B"], "cost": 1}}
+        feature = Feature('flow', TupleLabeling([Feature('ip', IPv4PrefixLabeling()),
+                                                 Feature('proto', DValueLabeling(4)),
+                                                 Feature('host', HierarchicalLabeling(label_info))]))
+        labeling = feature.labeling
+
+        r = random.Random(1)
+        labels = set()
+        while len(labels) < 200:
+            labels.add((IPv4Prefix('10.%d.%d.%d/%d' % (r.randint(0, 3), r.randint(0, 255), r.randint(0, 255),
+                                                      r.choice([32, 32, 32, 24]))).cidr,
+                        r.choice(["tcp", "udp", "*"]), r.choice(["a1", "a2", "b1", "b2", "A", "B"])))
+        specs = [labeling.join(l, l) for l in sorted(labels, key=str)]
+
+        index = TupleIndex(feature)
+        for i, s in enumerate(specs):
+            index.insert(s, i)
+        self.assertEqual(index.get_stats()["entries"], len(specs))
+
+        for q in range(30):
+            key = labeling.join(r.choice(specs).value, r.choice(specs).value)
+            expected = sorted(i for i, s in enumerate(specs) if labeling.subset(s.value, key.value))
+            self.assertEqual(sorted(i for _, i in index.get_subsets(key)), expected)
+
+            key = r.choice(specs)
+            expected = sorted(i for i, s in enumerate(specs) if labeling.subset(key.value, s.value))
+            self.assertEqual(sorted(i for _, i in index.get_supersets(key)), expected)
+
+            # nearest neighbors are exact
+            dists = sorted(labeling.join(s.value, key.value).cost - s.cost - key.cost for s in specs)
+            self.assertEqual([d for d, _, _ in index.get_knn_approx(key, 3)], dists[:3])
+
+        key = labeling.join(specs[0].value, specs[1].value)
+        subsets = [i for i, s in enumerate(specs) if labeling.subset(s.value, key.value)]
+        self.assertEqual(index.remove_subset(key), sum(specs[i].cost for i in subsets))
+        self.assertEqual(index.get_subsets(key), [])
+        self.assertEqual(index.get_stats()["entries"], len(specs) - len(subsets))
+
+    def test_deep_index(self):
+        # chains of single child nodes (far deeper than the recursion limit) above the leaves of both indexes
+        import netaddr
+        from .labeling import Feature, Spec
+        from .ip_labeling import IPv4PrefixLabeling
+
+        feature = Feature('ip', IPv4PrefixLabeling())
+        depth = 20000
+        for index in [RTreeIndex(feature), TupleIndex(feature)]:
+            for i in range(4):
+                index.insert(Spec(1, netaddr.IPNetwork('10.0.0.%d/32' % i)), i)
+            for d in range(depth):
+                if isinstance(index, RTreeIndex):
+                    root = RtreeIndexNode(index.root.bounding_box)
+                    root.covered_approx = index.root.covered_approx
+                else:
+                    root = TupleIndexNode()
+                root.is_leaf = False
+                root.objects = [index.root]
+                if isinstance(index, TupleIndex):
+                    index.update(root)
+                index.root = root
+
+            index.insert(Spec(1, netaddr.IPNetwork('10.0.0.4/32')), 4)
+            self.assertEqual(len(index.get_all_nodes()), depth + 1)
+            self.assertEqual(sorted(v for _, v in index.get_subsets(Spec(8, netaddr.IPNetwork('10.0.0.0/29')))),
+                             [0, 1, 2, 3, 4])
+            self.assertEqual([v for _, v in index.get_supersets(Spec(1, netaddr.IPNetwork('10.0.0.2/32')))], [2])
+            self.assertEqual(index.remove_subset(Spec(2, netaddr.IPNetwork('10.0.0.0/31'))), 2)
+            self.assertEqual(sorted(v for _, v in index.get_subsets(Spec(8, netaddr.IPNetwork('10.0.0.0/29')))),
+                             [2, 3, 4])
@@ -31,6 +31,16 @@ class IPv4PrefixLabeling(Labeling):
 
         return Spec((1 << (32 - prefixlen)), ret)
 
+    def join_cost(self, l1, l2):
+        # the joined prefix spans the highest differing bit of the two ranges
+        return 1 << (min(l1.first, l2.first) ^ max(l1.last, l2.last)).bit_length()
+
+    def join_bounded(self, l1, l2, max_cost):
+        # the joined prefix is only built when its cost is within the bound
+        if self.join_cost(l1, l2) > max_cost:
+            return None
+        return self.join(l1, l2)
+
     def meet(self, l1, l2):
         meet = netaddr.IPSet(l1) & netaddr.IPSet(l2)
         if len(meet) == 0:
@@ -42,7 +52,8 @@ class IPv4PrefixLabeling(Labeling):
         return Spec(len(meet), cidrs[0])
 
     def subset(self, l1, l2):
-        return netaddr.IPSet(l1).issubset(l2)
+        # prefixes are either nested or disjoint
+        return l2.first <= l1.first and l1.last <= l2.last
 
     def cost(self, l):
         return len(l)
@@ -50,6 +61,21 @@ class IPv4PrefixLabeling(Labeling):
     def top(self):
         return netaddr.IPNetwork('0.0.0.0/0')
 
+    def locality_keys(self, l):
+        # same-prefix buckets at a few granularities
+        return [(p, l.first >> (32 - p)) for p in (24, 16, 8) if p <= l.prefixlen]
+
+    def interval(self, l):
+        return (l.first, l.last)
+
+    def join_cost_lower_bound(self, l, lo, hi):
+        # the join has to cover l and at least the closest address of the range
+        if hi < l.first:
+            return 1 << (hi ^ l.last).bit_length()
+        if lo > l.last:
+            return 1 << (l.first ^ lo).bit_length()
+        return len(l)
+
 
 class IPv4PrefixSetLabeling(Labeling):
     def join(self, l1, l2):
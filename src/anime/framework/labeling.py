@@ -11,6 +11,8 @@ import json
 Spec = collections.namedtuple('Spec', ['cost', 'value'])
 
 class Labeling(object):
+    # rough relative expense of a join, the features of a tuple are joined cheapest first
+    join_expense = 1
 
     def join(self, l1, l2):
         # return: Spec(cost, joined label)
@@ -19,6 +21,25 @@ class Labeling(object):
     def join(self,s):
         assert False
 
+    def join_cost(self, l1, l2):
+        # cost of the join without materializing the joined label; labelings override this when it is cheaper
+        return self.join(l1, l2).cost
+
+    # bounded joins return None as soon as it is known that the cost of the join exceeds max_cost
+    # (labelings stop early where they can; costs are assumed to be at least 1)
+    def join_bounded(self, l1, l2, max_cost):
+        spec = self.join(l1, l2)
+        return spec if spec.cost <= max_cost else None
+
+    def join_cost_bounded(self, l1, l2, max_cost):
+        cost = self.join_cost(l1, l2)
+        return cost if cost <= max_cost else None
+
+    def join_costs_bounded(self, l, others, max_costs):
+        # join costs of l with each of others, None where it exceeds the corresponding max cost (None for no bound)
+        return [self.join_cost(l, o) if max_cost is None else self.join_cost_bounded(l, o, max_cost)
+                for o, max_cost in zip(others, max_costs)]
+
     def cost(self, l):
         assert False
 
@@ -38,6 +59,19 @@ class Labeling(object):
     def top(self):
         assert False
 
+    def locality_keys(self, l):
+        # hashable keys of "nearby" labels (finer first), used to pick clustering candidates; none by default
+        return []
+
+    # embedding of labels as integer intervals, used by TupleIndex to bound each feature on its own:
+    # l1 subset of l2 implies that the interval of l1 is within the interval of l2 (None if there is no embedding)
+    def interval(self, l):
+        return None
+
+    def join_cost_lower_bound(self, l, lo, hi):
+        # lower bound of the cost of the join of l with any label whose interval is within [lo, hi]
+        return 1
+
 class Feature(object):
     def __init__(self, name, labeling):
         self.name = name
@@ -52,6 +86,7 @@ class HierarchicalLabeling(Labeling):
         self.predecessors = {}
         self.successors = {}
         self.top_label = None
+        self.intervals = None
 
         for l, info in label_info.items():
             info["children"] = set()
@@ -162,6 +197,38 @@ class HierarchicalLabeling(Labeling):
     def top(self):
         return self.top_label
 
+    def locality_keys(self, l):
+        # the label itself, then same-parent buckets
+        return [l] + sorted(self.label_info[l]["parents"])
+
+    def compute_intervals(self):
+        # DFS numbering (first visit) of a spanning tree of the DAG; the interval of a label spans all its successors
+        position = {}
+        stack = [self.top_label]
+        while stack:
+            l = stack.pop()
+            if l in position:
+                continue
+            position[l] = len(position)
+            stack.extend(sorted(self.label_info[l]["children"], reverse=True))
+
+        self.intervals = {}
+        for l in self.label_info:
+            positions = [position[c] for c in self.get_successors(l)]
+            self.intervals[l] = (min(positions), max(positions))
+
+    def interval(self, l):
+        if self.intervals is None:
+            self.compute_intervals()
+        return self.intervals[l]
+
+    def join_cost_lower_bound(self, l, lo, hi):
+        # no successor of l in the range: the join is a strict ancestor of l
+        l_lo, l_hi = self.interval(l)
+        if hi < l_lo or lo > l_hi:
+            return min([self.cost(p) for p in self.label_info[l]["parents"]] or [self.cost(l)])
+        return self.cost(l)
+
 
 class DValueLabeling(Labeling):
     top_symbol = "*"
@@ -170,6 +237,8 @@ class DValueLabeling(Labeling):
         self.top_cost = top_cost
         self.atom_cost = atom_cost
         self.top_card = top_card
+        # values are numbered as they are first seen, the top covers all numbers
+        self.ordinals = {}
 
     def join(self, l1, l2):
         if l2 == DValueLabeling.top_symbol or l2 == DValueLabeling.top_symbol or l1 != l2:
@@ -194,10 +263,28 @@ class DValueLabeling(Labeling):
     def top(self):
         return DValueLabeling.top_symbol
 
+    def locality_keys(self, l):
+        return [] if l == DValueLabeling.top_symbol else [l]
+
+    def interval(self, l):
+        if l == DValueLabeling.top_symbol:
+            return (0, 1 << 62)
+        ordinal = self.ordinals.setdefault(l, len(self.ordinals) + 1)
+        return (ordinal, ordinal)
+
+    def join_cost_lower_bound(self, l, lo, hi):
+        # any join with the top is the top; l itself is only reached if it is in the range
+        if l != DValueLabeling.top_symbol and lo <= self.interval(l)[0] <= hi:
+            return self.atom_cost
+        return self.top_cost
+
     def subset(self, l1, l2):
         return l1 == l2 or (l1 != DValueLabeling.top_symbol and l2 == DValueLabeling.top_symbol)
 
     def cardinality(self, l):
+        # an atom is a single value (its cost is only the cost of naming it)
+        if l != DValueLabeling.top_symbol:
+            return 1
         if self.top_card is None:
             return self.top_cost
         else:
@@ -207,6 +294,12 @@ class DValueLabeling(Labeling):
 class TupleLabeling(Labeling):
     def __init__(self, features):
         self.features = features
+        # order in which bounded joins go through the features; costs are still multiplied in feature order
+        self.join_order = sorted(range(len(features)), key=lambda f: features[f].labeling.join_expense)
+
+    @property
+    def join_expense(self):
+        return sum(f.labeling.join_expense for f in self.features)
 
     def join(self, a, b):
         joined = []
@@ -218,6 +311,79 @@ class TupleLabeling(Labeling):
 
         return Spec(cost, tuple(joined))
 
+    def join_cost(self, a, b):
+        cost = 1
+        for f in range(len(self.features)):
+            cost *= self.features[f].labeling.join_cost(a[f], b[f])
+        return cost
+
+    def join_bounded(self, a, b, max_cost):
+        # each feature gets what is left of the budget, the product only grows
+        specs = [None] * len(self.features)
+        cost = 1
+        for f in self.join_order:
+            spec = self.features[f].labeling.join_bounded(a[f], b[f], max_cost / cost)
+            if spec is None:
+                return None
+            specs[f] = spec
+            cost *= spec.cost
+            if cost > max_cost:
+                return None
+
+        cost = 1
+        for spec in specs:
+            cost *= spec.cost
+        return Spec(cost, tuple(spec.value for spec in specs))
+
+    def join_cost_bounded(self, a, b, max_cost):
+        costs = [None] * len(self.features)
+        cost = 1
+        for f in self.join_order:
+            c = self.features[f].labeling.join_cost_bounded(a[f], b[f], max_cost / cost)
+            if c is None:
+                return None
+            costs[f] = c
+            cost *= c
+            if cost > max_cost:
+                return None
+
+        cost = 1
+        for c in costs:
+            cost *= c
+        return cost
+
+    def join_costs_bounded(self, l, others, max_costs):
+        """
+            Goes feature by feature (cheapest first) over all the candidates that are left, so that the expensive
+            features are only joined for the candidates whose cheaper features keep them within their bound
+        """
+        costs = [[None] * len(self.features) for o in others]
+        partial = [1] * len(others)
+        left = [k for k in range(len(others))]
+        for f in self.join_order:
+            feature_costs = self.features[f].labeling.join_costs_bounded(
+                l[f], [others[k][f] for k in left],
+                [None if max_costs[k] is None else max_costs[k] / partial[k] for k in left])
+
+            still_left = []
+            for k, c in zip(left, feature_costs):
+                if c is None:
+                    continue
+                partial[k] *= c
+                if max_costs[k] is not None and partial[k] > max_costs[k]:
+                    continue
+                costs[k][f] = c
+                still_left.append(k)
+            left = still_left
+
+        res = [None] * len(others)
+        for k in left:
+            cost = 1
+            for c in costs[k]:
+                cost *= c
+            res[k] = cost
+        return res
+
     def meet(self, a, b):
         meet = []
         cost = 1
@@ -255,5 +421,10 @@ class TupleLabeling(Labeling):
     def top(self):
         return tuple(f.labeling.top() for f in self.features)
 
+    def locality_keys(self, l):
+        # keys of all features, tagged with the feature index, finer keys of every feature first
+        keys = [[(i, key) for key in self.features[i].labeling.locality_keys(l[i])] for i in range(len(self.features))]
+        return [k[r] for r in range(max([len(k) for k in keys] + [0])) for k in keys if r < len(k)]
+
 
 
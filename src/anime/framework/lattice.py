@@ -7,16 +7,23 @@ __email__ =  "kheradm2@illinois.edu"
 
 
 import logging as log
+import collections
 
 
 class LatticeNode(object):
-    #__slots__ = ["label", "children", "cardinality"]
+    __slots__ = ["label", "children", "cardinality"]
 
     def __init__(self, l):
         self.label = l
-        self.children = set()
+        # most nodes are leaves: the set of children is only created with the first child
+        self.children = ()
         self.cardinality = None
 
+    def add_child(self, c):
+        if not self.children:
+            self.children = set()
+        self.children.add(c)
+
     def __repr__(self):
         return "%s, %s" % (self.label, self.cardinality)
 
@@ -51,9 +58,11 @@ class MeetSemiLattice(object):
         self.print_subtree(self.root)
 
     def print_subtree(self, n, level = 1):
-        print("-"*level, n)
-        for c in n.children:
-            self.print_subtree(c, level + 1)
+        stack = [(n, level)]
+        while stack:
+            n, level = stack.pop()
+            print("-"*level, n)
+            stack.extend((c, level + 1) for c in reversed(list(n.children)))
 
     def get_label_subtree(self, l):
         n, new = self.get_node(l)
@@ -63,31 +72,80 @@ class MeetSemiLattice(object):
 
     def get_cardinality(self, n):
         if n.cardinality is None:
-            subtree = self.get_node_subtree(n) - set([n])
-            card = self.feature.labeling.cardinality(n.label)
-            n.cardinality = card - sum([self.get_cardinality(c) for c in subtree])
-            #print "for ", n, "=", card, "-", [self.get_cardinality(c) for c in subtree]
+            self.compute_all_cardinality()
 
         return n.cardinality
 
     def compute_all_cardinality(self):
-        self.get_cardinality(self.root)
+        """
+            Exclusive cardinality of every node (covered by its label but by none of its descendants): the
+            cardinality of its label minus the exclusive cardinalities of its descendants, in one bottom-up pass.
+            The exclusive cardinalities of a subtree add up to the cardinality of its root, so the walk over the
+            descendants of a node stops at the ones with only tree-shaped parts (no shared nodes) below them.
+        """
+        order = self.get_post_order(self.root)
+        parent_count = collections.Counter(c for n in order for c in n.children)
+        tree_below = {}
+        cardinality = self.feature.labeling.cardinality
+
+        for n in order:
+            tree_below[n] = all(parent_count[c] == 1 and tree_below[c] for c in n.children)
+
+            covered = 0
+            visited = set()
+            stack = list(n.children)
+            while stack:
+                d = stack.pop()
+                if d in visited:
+                    continue
+                visited.add(d)
+                if tree_below[d]:
+                    covered += cardinality(d.label)
+                else:
+                    covered += d.cardinality
+                    stack.extend(d.children)
+
+            n.cardinality = cardinality(n.label) - covered
+
+    def get_post_order(self, n):
+        # nodes of the subtree of n, each after all of its descendants
+        order = []
+        visited = set([n])
+        stack = [(n, iter(n.children))]
+        while stack:
+            c = next(stack[-1][1], None)
+            if c is None:
+                order.append(stack.pop()[0])
+            elif c not in visited:
+                visited.add(c)
+                stack.append((c, iter(c.children)))
+        return order
 
     def get_all_nodes(self):
         return list(self.label_to_node.values())
 
 
-    def _get_node_subtree(self, n, res):
-        res.add(n)
-        for c in n.children:
-            self._get_node_subtree(c, res)
-
     def get_node_subtree(self, n):
-        res = set()
-        self._get_node_subtree(n,res)
+        res = set([n])
+        stack = [n]
+        while stack:
+            for c in stack.pop().children:
+                if c not in res:
+                    res.add(c)
+                    stack.append(c)
         return res
 
     def insert_under(self, n, r):
+        # the recursive calls of _insert_under (yielded as (n, r)) run on an explicit stack, in the same order
+        stack = [self._insert_under(n, r)]
+        while stack:
+            call = next(stack[-1], None)
+            if call is None:
+                stack.pop()
+            else:
+                stack.append(self._insert_under(*call))
+
+    def _insert_under(self, n, r):
         log.debug("Inserting %s under %s", n, r)
 
         assert(self.subset(n.label, r.label))
@@ -103,7 +161,7 @@ class MeetSemiLattice(object):
         for c in r.children:
             if self.subset(n.label, c.label):
                 log.debug("%s under child %s", n, c)
-                self.insert_under(n, c)
+                yield n, c
             elif self.subset(c.label, n.label):
                 log.debug("child %s under %s", c, n)
                 children.append(c)
@@ -115,9 +173,9 @@ class MeetSemiLattice(object):
                     m, new = self.get_node(m_label)
                     inter_children.append(m)
                     if new:
-                        self.insert_under(m, c)
+                        yield m, c
 
-        r.children.add(n)
+        r.add_child(n)
 
         # find max children
         for i,ic in enumerate(inter_children):
@@ -135,13 +193,13 @@ class MeetSemiLattice(object):
 
         for c in children:
             r.children.remove(c)
-            n.children.add(c)
+            n.add_child(c)
 
         for ic in inter_children:
             if ic:
                 if ic in r.children:
                     r.children.remove(ic)
-                n.children.add(ic)
+                n.add_child(ic)
 
 
 
@@ -167,7 +225,7 @@ class TestLattice(unittest.TestCase):
         self.assertEqual(lattice.get_cardinality(lattice.root), 2**32 - 1 - 4)
 
     def test_lattice_insertion_tuple(self):
-        from .labeling import *
+        from .labeling import Feature, TupleLabeling, DValueLabeling
 
         feature = Feature('tuple', TupleLabeling(
             [Feature('src',  DValueLabeling(3)), Feature('dst', DValueLabeling(3))]))
@@ -184,3 +242,18 @@ class TestLattice(unittest.TestCase):
         self.assertEqual(lattice.get_cardinality(lattice.root),9 - 3 -3 + 1)
 
 
+
+    def test_lattice_cardinality_partition(self):
+        from .labeling import Feature, TupleLabeling, DValueLabeling
+
+        feature = Feature('tuple', TupleLabeling(
+            [Feature('src',  DValueLabeling(3)), Feature('dst', DValueLabeling(3))]))
+
+        lattice = MeetSemiLattice(feature)
+        for l in [('*','X'), ('A','*'), ('*','Y'), ('B','*'), ('A','X'), ('C','Z')]:
+            lattice.insert(l)
+
+        # every value is covered exclusively by exactly one node
+        lattice.compute_all_cardinality()
+        self.assertEqual(sum([n.cardinality for n in lattice.get_all_nodes()]), 9)
+        self.assertEqual(lattice.get_cardinality(lattice.label_to_node[('A','*')]), 3 - 2)
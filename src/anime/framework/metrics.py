@@ -0,0 +1,142 @@
+__author__ = "Ali Kheradmand"
+__email__ =  "kheradm2@illinois.edu"
+
+"""
+    Counters and per-phase timers for the hot paths of clustering and indexing
+"""
+
+import time
+import collections
+
+
+class CountedMethod(object):
+    # stands in for a labeling method (as an instance attribute) and counts its calls
+    __slots__ = ["counts", "key", "method"]
+
+    def __init__(self, counts, key, method):
+        self.counts = counts
+        self.key = key
+        self.method = method
+
+    def __call__(self, *args):
+        self.counts[self.key] += 1
+        return self.method(*args)
+
+
+class Phase(object):
+    __slots__ = ["times", "name", "start"]
+
+    def __init__(self, times, name):
+        self.times = times
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.times[self.name] += time.perf_counter() - self.start
+
+
+class NullPhase(object):
+    __slots__ = []
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+class Metrics(object):
+    """
+        counts: event and call counters ("<feature>.<op>" for labeling calls), times: seconds per phase
+        (nested phases are also included in the phase around them), steps: per step snapshot of the counters
+        and times accumulated during the step, along with the gauges at its end.
+    """
+
+    enabled = True
+
+    # labeling methods whose calls are counted
+    labeling_ops = ["join", "join_cost", "join_bounded", "join_cost_bounded", "join_costs_bounded", "meet", "subset"]
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.times = collections.Counter()
+        self.steps = []
+        self.last_counts = collections.Counter()
+        self.last_times = collections.Counter()
+        self.instrumented = []
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def phase(self, name):
+        return Phase(self.times, name)
+
+    def instrument(self, labeling, name):
+        """
+            Counts the calls to the labeling methods of labeling and of the labelings it is made of
+            (features of a tuple, the labeling of an HRE), until uninstrument() is called
+        """
+        for op in self.labeling_ops:
+            if op in labeling.__dict__ or not hasattr(labeling, op):
+                # already instrumented (labeling shared between features) or not a labeling method
+                continue
+            setattr(labeling, op, CountedMethod(self.counts, "%s.%s" % (name, op), getattr(labeling, op)))
+            self.instrumented.append((labeling, op))
+
+        for feature in getattr(labeling, "features", []):
+            self.instrument(feature.labeling, "%s/%s" % (name, feature.name))
+        if hasattr(labeling, "labeling"):
+            self.instrument(labeling.labeling, "%s/labels" % name)
+
+    def uninstrument(self):
+        for labeling, op in self.instrumented:
+            delattr(labeling, op)
+        self.instrumented = []
+
+    def end_step(self, k, **gauges):
+        step = {"k": k}
+        step.update(gauges)
+        for name, value in self.counts.items():
+            step[name] = value - self.last_counts[name]
+        for name, value in self.times.items():
+            step["time." + name] = value - self.last_times[name]
+        self.steps.append(step)
+        self.last_counts = self.counts.copy()
+        self.last_times = self.times.copy()
+
+    def summary(self):
+        res = dict(self.counts)
+        for name, value in self.times.items():
+            res["time." + name] = value
+        res["steps"] = len(self.steps)
+        return res
+
+    def store_steps_csv(self, filename):
+        columns = []
+        for step in self.steps:
+            columns += [c for c in step if c not in columns]
+        with open(filename, 'w') as f:
+            f.write(",".join(columns) + "\n")
+            for step in self.steps:
+                f.write(",".join(str(step.get(c, 0)) for c in columns) + "\n")
+
+
+class NullMetrics(Metrics):
+    # the default: no counting, no timing, no instrumentation
+    enabled = False
+
+    null_phase = NullPhase()
+
+    def count(self, name, n=1):
+        pass
+
+    def phase(self, name):
+        return NullMetrics.null_phase
+
+    def instrument(self, labeling, name):
+        pass
+
+    def end_step(self, k, **gauges):
+        pass
@@ -165,52 +165,21 @@ def mp_get_closets_cluster(c_cluster):
         assert res[1][2][1] == c
         return c, res[0][2][1]
 
-class ParallelHierarchicalClusteringWithIndex(HierarchicalClustering):
+class ParallelHierarchicalClusteringWithIndex(HierarchicalClusteringWithIndex):
 
     def cluster(self, flows, feature, callback=None, processes=4):
-        flow_labeling = feature.labeling
-
-        batch_size = self.batch_size
-        if batch_size == 0:
-            batch_size = len(flows)
-
-        self.clusters = [flow_labeling.join(flow, flow) for flow in flows]
-        self.parents = list(range(len(self.clusters)))
-        self.closest_clusters = [[]] * len(self.clusters)
-
-        logging.info("Initial clusters added")
-
-        heap = []
-        overall_cost = sum([c.cost for c in self.clusters])
-
-        start = time.time()
-
-        remaining_clusters = set(range(len(flows)))
-
-        index = RTreeIndex(feature)
-
-        logging.info("Indexing flows")
-
-        for i in range(len(self.clusters)):
-            index.insert(self.clusters[i], i)
-
-        logging.info("Finished indexing flows in %s seconds", time.time() - start)
-
-
-        # for i in range(len(self.clusters)):
-        #     logging.info("Adding distances for cluster %s", i)
-        #
-        #     j = get_closest_cluster(i)
-        #     joined = flow_labeling.join(self.clusters[i].value, self.clusters[j].value)
-        #     dist = cost_gain_distance(self.clusters[i], self.clusters[j], joined)
-        #     heapq.heappush(heap, (dist, joined, (i, j)))
+        self.processes = processes
+        return super(ParallelHierarchicalClusteringWithIndex, self).cluster(flows, feature, callback)
 
+    def initial_distances(self, feature):
+        # only the initial closest clusters are computed in parallel, merging is the same as the serial version
+        self.build_index(feature)
 
         # ray.init(num_cpus=processes)
         #
         # timer_start = time.time()
         # logging.info("Putting index in the object store")
-        # index_id = ray.put(index)
+        # index_id = ray.put(self.index)
         # logging.info("Finished putting index in the object store in %s seconds", time.time() - timer_start)
         #
         # timer_start = time.time()
@@ -237,141 +206,21 @@ class ParallelHierarchicalClusteringWithIndex(HierarchicalClustering):
 
         timer_start = time.time()
         global mp_index
-        mp_index = index
-        pool = Pool(4)
+        mp_index = self.index
+        pool = Pool(self.processes)
         it = pool.imap_unordered(mp_get_closets_cluster, [(c,self.clusters[c]) for c in range(len(self.clusters))])
         ctr = 0
         for i,j in it:
             ctr += 1
             logging.info("Adding distances for cluster %s (%s)", i, ctr)
-            joined = flow_labeling.join(self.clusters[i].value, self.clusters[j].value)
-            dist = cost_gain_distance(self.clusters[i], self.clusters[j], joined)
-            heapq.heappush(heap, (dist, joined, (i, j)))
+            cost = self.flow_labeling.join_cost(self.clusters[i].value, self.clusters[j].value)
+            dist = cost_gain_distance(self.clusters[i], self.clusters[j], Spec(cost, None))
+            self.push_pair((dist, i, j))
         pool.close()
         logging.info("Finished adding closest clusters for initial clusters in %s seconds",
                          time.time() - timer_start)
 
 
-        def get_closest_cluster(c):
-            res = index.get_knn_approx(self.clusters[c])
-            #res = index.get_knn_precise(self.clusters[c])
-
-            if len(res) < 2:
-                assert res[0][2][1] == c
-                return None
-            elif res[0][2][1] == c:
-                return res[1][2][1]
-            else:
-                logging.warning("The first item of nearest neighbors isn't the cluster itself %s", res)
-                assert res[1][2][1] == c
-                return res[0][2][1]
-
-            # assert res[0][2][1] == c
-            # return None if len(res) < 2 else res[1][2][1]
-
-        self.stats.append((len(remaining_clusters), overall_cost, time.time() - start))
-        logging.info(self.stats[-1])
-
-        self.intents.append(IncrementalIntentInfo(len(remaining_clusters), list(remaining_clusters), []))
-        if callback:
-            callback(self, remaining_clusters)
-
-        while len(remaining_clusters) > self.cluster_count:
-            logging.info("Number of clusters so far %s", len(remaining_clusters))
-
-            removed = []
-
-            best = None
-            while True:
-
-                candidate = heapq.heappop(heap)
-                c_1, c_2 = candidate[2]
-
-                if c_1 in remaining_clusters:
-                    if c_2 in remaining_clusters:
-                        best = candidate
-                        break
-                    else:
-                        j = get_closest_cluster(c_1)
-                        joined = flow_labeling.join(self.clusters[c_1].value, self.clusters[j].value)
-                        dist = cost_gain_distance(self.clusters[c_1], self.clusters[j], joined)
-                        heapq.heappush(heap, (dist, joined, (c_1, j)))
-                else:
-                    if c_2 in remaining_clusters:
-                        j = get_closest_cluster(c_2)
-                        joined = flow_labeling.join(self.clusters[c_2].value, self.clusters[j].value)
-                        dist = cost_gain_distance(self.clusters[c_2], self.clusters[j], joined)
-                        heapq.heappush(heap, (dist, joined, (c_2, j)))
-
-            assert best is not None
-
-            new_cluster_id = len(self.clusters)
-            best_clusters_to_merge = best[2]
-            best_new_cluster = best[1]
-            best_distance = best[0]
-            logging.info("Final best distance is %s %s with cluster id %s by merging %s %s %s",
-                         best_distance, best_new_cluster, new_cluster_id, best_clusters_to_merge,
-                         self.clusters[best_clusters_to_merge[0]], self.clusters[best_clusters_to_merge[1]])
-
-            overall_cost += best_distance
-
-            self.clusters.append(best_new_cluster)
-            remaining_clusters -= set([best_clusters_to_merge[0], best_clusters_to_merge[1]])
-            # removed += best_clusters_to_merge # will automatically happen when removing subsumed clusters
-
-
-            self.closest_clusters.append([])
-
-            self.parents.append(new_cluster_id)
-            # self.parents[best_clusters_to_merge[0]] = new_cluster_id
-            # self.parents[best_clusters_to_merge[1]] = new_cluster_id
-
-            cost_sanity_check = self.clusters[new_cluster_id].cost
-
-            subsumed = index.get_subsets(best_new_cluster)
-            subsumed = [x[1] for x in subsumed]
-            index.remove_subset(best_new_cluster)
-
-            # remove subsumed clusters
-            overall_cost -= sum([self.clusters[c].cost for c in subsumed])
-            removed += subsumed
-            remaining_clusters -= set(subsumed)
-
-            for c in subsumed:
-                logging.info("subsumed %s", self.clusters[c])
-                self.parents[c] = new_cluster_id
-
-            min_dist = None
-
-            remaining_clusters.add(new_cluster_id)
-
-            index.insert(best_new_cluster, new_cluster_id)
-
-            if len(remaining_clusters) > 1:
-                j = get_closest_cluster(new_cluster_id)
-                joined = flow_labeling.join(self.clusters[new_cluster_id].value, self.clusters[j].value)
-                dist = cost_gain_distance(self.clusters[new_cluster_id], self.clusters[j], joined)
-                heapq.heappush(heap, (dist, joined, (new_cluster_id, j)))
-
-            self.stats.append((len(remaining_clusters), overall_cost, time.time() - start))
-            logging.info("Cumulative cost is %s", overall_cost)
-            logging.info(self.stats[-1])
-
-            self.intents.append(IncrementalIntentInfo(len(remaining_clusters), [new_cluster_id], removed))
-            if callback:
-                callback(self, remaining_clusters)
-
-        # clustering is done
-        logging.info("Clustering is finished")
-        logging.info(">time %s", str(time.time() - start))
-        logging.info(">recounts %s", len(self.closest_clusters_recomputations))
-        # self.store_stats_csv()
-        if plot:
-            self.plot_stats(sum((x.cost for x in self.clusters[:len(flows)])))
-
-        return [self.clusters[c] for c in remaining_clusters]
-
-
 
 
 
@@ -1,10 +1,15 @@
 __author__ = "Ali Kheradmand"
 __email__ =  "kheradm2@illinois.edu"
 
+import os
+import random
+import tempfile
 import unittest
 from .ip_labeling import *
 from .labeling import *
 from .hregex import *
+from .clustering import *
+from .dendrogram import Dendrogram
 
 
 class TestAnime(unittest.TestCase):
@@ -57,6 +62,69 @@ class TestAnime(unittest.TestCase):
         self.assertEqual(labeling.join(HRegex(["u1", "s1"]), HRegex(["u1", "s2+"])), Spec(6, HRegex(["u1", "Server+"])))
         self.assertEqual(labeling.join(HRegex(["u1", "s1"]), HRegex(["s1", "u1"])), Spec(16, HRegex(["Any+"])))
 
+    def test_join_bounded(self):
+        labeling = HRegexLabeling(HierarchicalLabeling(TestAnime.label_info))
+        paths = [HRegex(["u1", "s1"]), HRegex(["u1", "s2"]), HRegex(["u2", "s2"]), HRegex(["u1", "s2+"]),
+                 HRegex(["s1", "u1"]), HRegex(["u1", "s1", "s2"])]
+        flows, feature = TestAnime.tuple_flows(20)
+        cases = [(labeling, a, b) for a in paths for b in paths] + \
+                [(feature.labeling, a, b) for a in flows for b in flows]
+
+        for labeling, a, b in cases:
+            joined = labeling.join(a, b)
+            for max_cost in [joined.cost - 1, joined.cost * 0.99, joined.cost, joined.cost + 1]:
+                if joined.cost <= max_cost:
+                    self.assertEqual(labeling.join_bounded(a, b, max_cost), joined)
+                    self.assertEqual(labeling.join_cost_bounded(a, b, max_cost), joined.cost)
+                else:
+                    self.assertIsNone(labeling.join_bounded(a, b, max_cost))
+                    self.assertIsNone(labeling.join_cost_bounded(a, b, max_cost))
+
+    def test_join_costs_bounded(self):
+        from .metrics import Metrics
+
+        paths = HRegexLabeling(HierarchicalLabeling(TestAnime.label_info))
+        labeling = TupleLabeling([Feature('path', paths), Feature('proto', DValueLabeling(5))])
+        self.assertEqual(labeling.join_order, [1, 0])
+
+        r = random.Random(2)
+        flows = [(HRegex([r.choice(["u1", "u2", "s1", "s2"]) for i in range(2)]), r.choice("xyz")) for j in range(20)]
+        max_costs = [None if k % 3 == 0 else r.choice([1, 6, 10, 30]) for k in range(len(flows))]
+        expected = [labeling.join_cost(flows[0], b) if m is None else labeling.join_cost_bounded(flows[0], b, m)
+                    for b, m in zip(flows, max_costs)]
+
+        metrics = Metrics()
+        metrics.instrument(labeling, "flow")
+        self.assertEqual(labeling.join_costs_bounded(flows[0], flows, max_costs), expected)
+        metrics.uninstrument()
+        # pairs with a different protocol and a bound below 5 never get to the path join
+        cut = len([b for b, m in zip(flows, max_costs) if m is not None and m < 5 and b[1] != flows[0][1]])
+        self.assertGreater(cut, 0)
+        self.assertEqual(metrics.counts["flow/path.join_cost"] + metrics.counts["flow/path.join_cost_bounded"],
+                         len(flows) - cut)
+
+    def test_dvalue_cardinality(self):
+        # an atom covers one value; only the top covers top_card (or top_cost) values
+        for labeling, top in [(DValueLabeling(10, 1), 10), (DValueLabeling(10, 2, 7), 7)]:
+            self.assertEqual(labeling.cardinality("tcp"), 1)
+            self.assertEqual(labeling.cardinality(1000), 1)
+            self.assertEqual(labeling.cardinality(DValueLabeling.top_symbol), top)
+
+    def test_join_cost_lower_bound(self):
+        labeling = DValueLabeling(10, 1)
+        labels = [DValueLabeling.top_symbol, "tcp", "udp", "icmp"]
+        for l in labels:
+            for b in labels:
+                lo, hi = labeling.interval(b)
+                # exact for the range of a single atom (the range of the top also holds every atom)
+                if b != DValueLabeling.top_symbol:
+                    self.assertEqual(labeling.join_cost_lower_bound(l, lo, hi), labeling.join(l, b).cost)
+                # a lower bound for the labels of a wider range
+                for other in labels:
+                    lo2, hi2 = labeling.interval(other)
+                    self.assertLessEqual(labeling.join_cost_lower_bound(l, min(lo, lo2), max(hi, hi2)),
+                                         min(labeling.join(l, b).cost, labeling.join(l, other).cost))
+
     def test_sequential_inference_dval(self):
         inference = SequentialInference(DValueLabeling(10, 1))
 
@@ -83,6 +151,503 @@ class TestAnime(unittest.TestCase):
         self.assertEqual(labeling.join(HRegex(["s1", "u1"]), HRegex(["s1", "u1"])), Spec(4, HRegex(["s1", "u1"])))
 
 
+    @staticmethod
+    def tuple_flows(n=40, seed=1):
+        r = random.Random(seed)
+        feature = Feature('flow', TupleLabeling([Feature('src', HierarchicalLabeling(TestAnime.label_info)),
+                                                 Feature('proto', DValueLabeling(5)),
+                                                 Feature('dst', HierarchicalLabeling(TestAnime.label_info))]))
+        leaves = ["s1", "s2", "u1", "u2"]
+        flows = sorted(set((r.choice(leaves), r.choice("xyz"), r.choice(leaves)) for i in range(n)))
+        return flows, feature
+
+    def test_resume_from_checkpoint(self):
+        flows, feature = TestAnime.tuple_flows()
+
+        random.seed(1)
+        uninterrupted = HierarchicalClustering(1, 5)
+        uninterrupted.cluster(flows, feature)
+
+        class Crash(Exception):
+            pass
+
+        def crash(clustering, remaining):
+            if len(remaining) <= 12:
+                raise Crash()
+
+        checkpoint = os.path.join(tempfile.mkdtemp(), "checkpoint.pk")
+        random.seed(1)
+        with self.assertRaises(Crash):
+            HierarchicalClustering(1, 5, checkpoint_path=checkpoint, checkpoint_every=3).cluster(flows, feature, crash)
+
+        random.seed(2)
+        resumed = HierarchicalClustering(1, 5)
+        resumed.resume(checkpoint, feature)
+
+        self.assertEqual(resumed.clusters, uninterrupted.clusters)
+        self.assertEqual(resumed.parents, uninterrupted.parents)
+        self.assertEqual(list(resumed.intents), list(uninterrupted.intents))
+
+
+    def test_add_flows(self):
+        flows, feature = TestAnime.tuple_flows(60)
+        clustering = HierarchicalClusteringWithIndex(3)
+        clustering.cluster(flows[:30], feature)
+        clusters = clustering.add_flows(flows[30:])
+
+        self.assertEqual(len(clusters), 3)
+        for f in flows:
+            self.assertTrue(any(feature.labeling.subset(f, c.value) for c in clusters))
+
+        # replaying the intents must give the remaining clusters, with consistent k at every step
+        alive = set()
+        for info in clustering.intents:
+            alive = (alive - set(info.removed)) | set(info.added)
+            self.assertEqual(info.k, len(alive))
+        self.assertEqual(alive, set(clustering.remaining_clusters))
+        self.assertEqual(clustering.intents[0].k, len(clustering.intents[0].added))
+
+
+    def test_early_stop(self):
+        flows, feature = TestAnime.tuple_flows(60)
+        for clustering in [HierarchicalClustering(1, max_cost_ratio=1.2), HierarchicalClusteringWithIndex(1, max_cost_ratio=1.2)]:
+            clusters = clustering.cluster(flows, feature)
+
+            self.assertEqual(clustering.stop_reason, "max_cost_ratio")
+            self.assertGreater(len(clusters), 1)
+            self.assertEqual(clustering.intents[-1].k, len(clusters))
+            self.assertLessEqual(clustering.stats[-2][1], 1.2 * clustering.stats[0][1])
+            self.assertEqual(clustering.stats[-1][1], sum(c.cost for c in clusters))
+
+
+    def test_dendrogram(self):
+        flows, feature = TestAnime.tuple_flows(60)
+        clustering = HierarchicalClustering(1)
+        clustering.cluster(flows, feature)
+        dendrogram = clustering.dendrogram
+
+        filename = os.path.join(tempfile.mkdtemp(), "dendrogram.bin")
+        dendrogram.to_file(filename)
+        loaded = Dendrogram.from_file(filename)
+        self.assertEqual(list(loaded), list(dendrogram))
+        self.assertEqual(loaded.parents, dendrogram.parents)
+        self.assertEqual(list(loaded.iter_stats()), list(dendrogram.iter_stats()))
+
+        # costs stay exact beyond float64, also through a file
+        for costs in [[2 ** 60 + 1, 2 ** 60 + 3], [3, 2.5], [2 ** 60 + 1, 0.5], [0.5, 2 ** 60 + 1], [2, 2 ** 64]]:
+            exact = Dendrogram(2)
+            for cost in costs:
+                exact.append_step(2, [0, 1], [], cost, 0.0)
+            exact.add_cost(0, 2)
+            expected = [costs[0] + 2] + costs[1:]
+            exact.to_file(filename)
+            for d in [exact, Dendrogram.from_file(filename)]:
+                self.assertEqual([c for _, c, _ in d.iter_stats()], expected)
+
+        alive = set()
+        for info in dendrogram:
+            alive = (alive - set(info.removed)) | set(info.added)
+            self.assertEqual(sorted(alive), loaded.get_alive(info.k))
+            for f in range(len(flows)):
+                ancestor = loaded.get_ancestor(f, info.k)
+                self.assertIn(ancestor, alive)
+                self.assertTrue(feature.labeling.subset(flows[f], clustering.clusters[ancestor].value))
+
+
+    def test_cuts(self):
+        flows, feature = TestAnime.tuple_flows(60)
+        clustering = HierarchicalClusteringWithIndex(1)
+        clustering.cluster(flows[:30], feature)
+        clustering.add_flows(flows[30:])
+
+        ks = [info.k for info in clustering.intents][::3]
+        flow_ids = clustering.dendrogram.get_flows()
+        self.assertEqual(len(flow_ids), len(flows))
+        for cut in clustering.cuts(ks):
+            self.assertEqual(cut.clusters, clustering.dendrogram.get_alive(cut.k))
+            self.assertEqual(list(cut.assignment), [clustering.dendrogram.get_ancestor(f, cut.k) for f in flow_ids])
+            self.assertEqual(cut.labels, [clustering.clusters[c] for c in cut.clusters])
+
+
+    def test_alive_and_ancestor_queries(self):
+        flows, feature = TestAnime.tuple_flows(80)
+        clustering = HierarchicalClusteringWithIndex(1)
+        clustering.cluster(flows[:50], feature)
+        clustering.add_flows(flows[50:])
+        dendrogram = clustering.dendrogram
+
+        for k in sorted(set(info.k for info in dendrogram))[::4]:
+            step = dendrogram.get_step(k)
+            alive = [c for c in range(len(dendrogram.parents)) if dendrogram.is_alive_at_step(c, step)]
+            self.assertEqual(dendrogram.get_alive(k), alive)
+            for f in dendrogram.get_flows():
+                # the first ancestor alive at the step, one parent at a time
+                c = f
+                while not dendrogram.is_alive_at_step(c, step):
+                    c = dendrogram.parents[c]
+                self.assertEqual(dendrogram.get_ancestor(f, k), c)
+
+    def test_locality_batches(self):
+        flows, feature = TestAnime.tuple_flows(60)
+
+        def check_buckets(clustering, remaining):
+            for key, bucket in clustering.locality_buckets.items():
+                self.assertEqual(set(bucket), set(c for c in remaining
+                                                  if key in feature.labeling.locality_keys(clustering.clusters[c].value)))
+
+        random.seed(1)
+        clustering = HierarchicalClustering(1, 5, locality_fraction=0.6)
+        clusters = clustering.cluster(flows, feature, check_buckets)
+        self.assertEqual(len(clusters), 1)
+
+    def test_subsumption_index(self):
+        flows, feature = TestAnime.tuple_flows(60)
+        for batch_size in [0, 5]:
+            random.seed(1)
+            clustering = HierarchicalClustering(1, batch_size, subsumption_index=True, locality_fraction=0.5)
+            clustering.cluster(flows, feature)
+
+            # every cluster is removed exactly when a cluster containing it is created
+            for info in clustering.intents[1:]:
+                for c in info.removed:
+                    self.assertTrue(feature.labeling.subset(clustering.clusters[c].value,
+                                                            clustering.clusters[info.added[0]].value))
+            alive = set()
+            for info in clustering.intents:
+                alive = (alive - set(info.removed)) | set(info.added)
+                for a in alive:
+                    for b in alive:
+                        if a != b:
+                            self.assertFalse(feature.labeling.subset(clustering.clusters[a].value,
+                                                                     clustering.clusters[b].value))
+
+
+    def test_join_cost(self):
+        labeling = IPv4PrefixLabeling()
+        prefixes = [IPv4Prefix(p) for p in ["192.168.1.0/32", "192.168.1.1/32", "192.168.1.0/24", "10.0.0.0/8",
+                                            "0.0.0.0/0", "255.255.255.255/32", "192.168.2.0/23"]]
+        for p1 in prefixes:
+            for p2 in prefixes:
+                self.assertEqual(labeling.join_cost(p1, p2), labeling.join(p1, p2).cost)
+
+        flows, feature = TestAnime.tuple_flows()
+        for f1 in flows:
+            for f2 in flows:
+                self.assertEqual(feature.labeling.join_cost(f1, f2), feature.labeling.join(f1, f2).cost)
+
+
+    def test_push_order_independence(self):
+        flows, feature = TestAnime.tuple_flows(60)
+
+        class ShuffledPushes(HierarchicalClusteringWithIndex):
+            # pushes the initial entries in random order, like parallel workers would
+            def initial_distances(self, feature):
+                self.build_index(feature)
+                entries = [self.closest_cluster_entry(i) for i in range(len(self.clusters))]
+                random.Random(7).shuffle(entries)
+                for entry in entries:
+                    self.push_pair(entry)
+
+        serial = HierarchicalClusteringWithIndex(1)
+        serial.cluster(flows, feature)
+        shuffled = ShuffledPushes(1)
+        shuffled.cluster(flows, feature)
+        self.assertEqual(list(serial.intents), list(shuffled.intents))
+        self.assertEqual(serial.parents, shuffled.parents)
+
+    def test_metrics(self):
+        flows, feature = TestAnime.tuple_flows(60)
+
+        plain = HierarchicalClusteringWithIndex(1)
+        plain.cluster(flows, feature)
+        measured = HierarchicalClusteringWithIndex(1, metrics=True)
+        measured.cluster(flows, feature)
+        self.assertEqual(list(plain.intents), list(measured.intents))
+        self.assertEqual(plain.get_metrics()["steps"], 0)
+
+        metrics = measured.get_metrics()
+        self.assertGreater(metrics["flow.join"], 0)
+        self.assertGreater(metrics["time.initial_distances"], 0)
+        self.assertLessEqual(metrics["stale_pops"], metrics["heap_pops"])
+        self.assertEqual(metrics["steps"], len(measured.intents))
+        self.assertEqual(sum(s.get("heap_pops", 0) for s in measured.metrics.steps), metrics["heap_pops"])
+        # labelings are back to normal once the clustering is done
+        self.assertNotIn("join", feature.labeling.__dict__)
+
+        # also when the clustering is interrupted by an exception
+        def interrupt(clustering, remaining):
+            if len(clustering.intents) > 2:
+                raise KeyboardInterrupt()
+        interrupted = HierarchicalClusteringWithIndex(1, metrics=True)
+        self.assertRaises(KeyboardInterrupt, interrupted.cluster, flows, feature, interrupt)
+        self.assertNotIn("join", feature.labeling.__dict__)
+        interrupted = HierarchicalClusteringWithIndex(len(flows) - 1, metrics=True)
+        interrupted.cluster(flows, feature)
+        self.assertRaises(KeyboardInterrupt, interrupted.add_flows, [("s1", "w", "s2"), ("u1", "w", "u2")], interrupt)
+        self.assertNotIn("join", feature.labeling.__dict__)
+        self.assertEqual(interrupted.metrics.instrumented, [])
+
+    def test_bulk_distances(self):
+        r = random.Random(3)
+        for measure in [join_cost_distance, cost_gain_distance, normalized_gain_distance, log_cost_gain_distance]:
+            cost_a = r.randint(1, 1000)
+            costs_b = [r.randint(1, 1000) for i in range(50)]
+            costs_joined = [cost_a + b + r.randint(0, 1000) for b in costs_b]
+            bulk = measure.bulk(cost_a, costs_b, costs_joined)
+            for b, j, d in zip(costs_b, costs_joined, bulk):
+                self.assertAlmostEqual(d, measure(Spec(cost_a, None), Spec(b, None), Spec(j, None)))
+
+        # costs of tuple labelings go beyond what float64 holds exactly: the distances stay exact
+        labeling = TupleLabeling([Feature(str(i), IPv4PrefixLabeling()) for i in range(3)])
+        top = labeling.cost(labeling.top())
+        self.assertGreater(top, 2 ** 53)
+        costs_b = [top // 2 ** i for i in range(20)]
+        costs_joined = [top] * 20
+        for measure in [join_cost_distance, cost_gain_distance, normalized_gain_distance, log_cost_gain_distance]:
+            self.assertEqual(measure.bulk(top - 1, costs_b, costs_joined),
+                             [measure(Spec(top - 1, None), Spec(b, None), Spec(j, None))
+                              for b, j in zip(costs_b, costs_joined)])
+        self.assertEqual(cost_gain_distance.bulk(2 ** 80 + 1, [1] * 16, [2 ** 80 + 3] * 16), [1] * 16)
+        # also when only some of them are large, or next to float costs
+        self.assertEqual(cost_gain_distance.bulk(1, [1, 2 ** 60] * 8, [2 ** 60 + 5] * 16), [2 ** 60 + 3, 4] * 8)
+        self.assertEqual(cost_gain_distance.bulk(1, [0.5, 2 ** 60] * 8, [2 ** 60 + 5] * 16),
+                         [2 ** 60 + 3.5, 4] * 8)
+
+        # same clustering with the bulk path as with a plain callable
+        flows, feature = TestAnime.tuple_flows(60)
+        intents = []
+        for measure in [cost_gain_distance, lambda a, b, joined: joined.cost - a.cost - b.cost]:
+            random.seed(5)
+            clustering = HierarchicalClustering(1, batch_size=20, distance_measure=measure)
+            clustering.cluster(flows, feature)
+            intents.append(list(clustering.intents))
+        self.assertEqual(intents[0], intents[1])
+
+    def test_tuple_index_clustering(self):
+        from .index import TupleIndex
+
+        flows, feature = TestAnime.tuple_flows(60)
+        for clustering in [HierarchicalClusteringWithIndex(3, index_class=TupleIndex),
+                           HierarchicalClustering(3, batch_size=20, subsumption_index=True, index_class=TupleIndex)]:
+            clusters = clustering.cluster(flows, feature)
+            self.assertIsInstance(clustering.index, TupleIndex)
+            self.assertEqual(clustering.overall_cost, sum(c.cost for c in clusters))
+            for flow in flows:
+                self.assertTrue(any(feature.labeling.subset(flow, c.value) for c in clusters))
+
+    def test_summary_evaluator(self):
+        from ..common.evaluation import SummaryEvaluator
+
+        flows, feature = TestAnime.tuple_flows(60)
+        clustering = HierarchicalClusteringWithIndex(1)
+        clustering.cluster(flows, feature)
+
+        res = SummaryEvaluator(flows, clustering.clusters, feature).evaluate(clustering.intents)
+        self.assertEqual(list(res), [info.k for info in clustering.intents])
+        tp = sum(feature.labeling.cardinality(f) for f in flows)
+        for k in res:
+            cut = clustering.cut(k)
+            self.assertEqual(res[k]["tp"], tp)
+            self.assertEqual(res[k]["fp"], sum(feature.labeling.cardinality(l.value) for l in cut.labels) - tp)
+            self.assertEqual(res[k]["cost"], clustering.dendrogram.cost[clustering.dendrogram.get_step(k)])
+
+        # same quantity as EvalSummarization in cpp/Eval.h: tp and fp in cost
+        res = SummaryEvaluator(flows, clustering.clusters, feature, quantity="cost").evaluate(clustering.intents)
+        tp = sum(feature.labeling.cost(f) for f in flows)
+        for k in res:
+            self.assertEqual(res[k]["tp"], tp)
+            self.assertEqual(res[k]["fp"], res[k]["cost"] - tp)
+
+    def test_per_cluster_evaluator(self):
+        from ..common.evaluation import PerClusterEvaluator
+
+        flows, feature = TestAnime.tuple_flows(40)
+        clustering = HierarchicalClusteringWithIndex(1)
+        clustering.cluster(flows, feature)
+
+        evaluator = PerClusterEvaluator(clustering.clusters, feature)
+        cardinality = feature.labeling.cardinality
+        seen = set()
+        for c, k, tp, pp, precision in evaluator.iter_results(clustering.dendrogram):
+            # rows come in post-order: the children of a cluster were all produced before it
+            self.assertTrue(all(clustering.parents[d] != c or d in seen for d in range(c)))
+            seen.add(c)
+            subtree = [f for f in range(len(flows)) if clustering.dendrogram.get_ancestor(f, k) == c]
+            self.assertEqual(tp, sum(cardinality(flows[f]) for f in subtree))
+            self.assertEqual(pp, cardinality(clustering.clusters[c].value))
+        self.assertEqual(seen, set(range(len(clustering.clusters))))
+        self.assertEqual(evaluator.ap, sum(cardinality(f) for f in flows))
+
+        # same quantity as PerClusterEval in cpp/Eval.h
+        evaluator = PerClusterEvaluator(clustering.clusters, feature, quantity="cost")
+        for c, k, tp, pp, precision in evaluator.iter_results(clustering.dendrogram):
+            subtree = [f for f in range(len(flows)) if clustering.dendrogram.get_ancestor(f, k) == c]
+            self.assertEqual(tp, sum(clustering.clusters[f].cost for f in subtree))
+            self.assertEqual(pp, clustering.clusters[c].cost)
+
+    def test_atom_cover_map(self):
+        import tempfile
+        from argparse import Namespace
+        from ..common.evaluation import IncrementalAtomCoverMapGenerator
+
+        flows, feature = TestAnime.tuple_flows(30)
+        clustering = HierarchicalClusteringWithIndex(1)
+        clustering.cluster(flows, feature)
+
+        with tempfile.TemporaryDirectory() as out:
+            generator = IncrementalAtomCoverMapGenerator(Namespace(out=out), clustering.clusters, feature)
+        cover_map = generator.get_cover_map(clustering.intents)
+
+        covered = set()
+        for info in clustering.intents:
+            subtrees = set()
+            for i in info.added:
+                subtrees |= generator.lattice.get_label_subtree(clustering.clusters[i].value)
+            self.assertEqual(set(cover_map[info.k]), subtrees - covered)
+            self.assertEqual(len(cover_map[info.k]), len(set(cover_map[info.k])))
+            covered |= subtrees
+
+    def test_evaluation_results(self):
+        from ..common.evaluation import EvaluationResults
+
+        res = {1: {"tp": 10, "fp": 10, "fn": 0}, 2: {"tp": 9, "fp": 3, "fn": 1}, 3: {"tp": 6, "fp": 3, "fn": 4},
+               4: {"tp": 4, "fp": 0, "fn": 6}, 5: {"tp": 1, "fp": 1, "fn": 9}}
+        results = EvaluationResults(res)
+        thresholds = [0.0, 0.5, 0.6, 0.7, 0.75, 0.8, 1.0]
+        ks = sorted(res)
+
+        def precision(k):
+            return res[k]["tp"] / (res[k]["tp"] + res[k]["fp"])
+
+        def recall(k):
+            return res[k]["tp"] / (res[k]["tp"] + res[k]["fn"])
+
+        self.assertEqual(results.largest_k_with_precision(thresholds),
+                         [max([k for k in ks if precision(k) >= t], default=None) for t in thresholds])
+        self.assertEqual(results.smallest_k_with_recall(thresholds),
+                         [min([k for k in ks if recall(k) >= t], default=None) for t in thresholds])
+        self.assertEqual(results.largest_k_with_precision(0.7), 4)
+
+    def test_parallel_cover_maps(self):
+        from ..common.evaluation import IncrementalCoverMapGenerator, compute_cover_maps_parallel, index_partition
+
+        flows, feature = TestAnime.tuple_flows(30)
+        samples, _ = TestAnime.tuple_flows(60, seed=2)
+        clustering = HierarchicalClusteringWithIndex(1)
+        clustering.cluster(flows, feature)
+
+        generators = [IncrementalCoverMapGenerator("positive", flows, clustering.clusters, feature),
+                      IncrementalCoverMapGenerator("negative", samples, clustering.clusters, feature)]
+        parallel = compute_cover_maps_parallel(generators, clustering.intents, 3)
+        for g, cover_map in zip(generators, parallel):
+            sequential = g.compute_cover_map(clustering.intents)
+            self.assertEqual(cover_map, {k: sorted(accepted) for k, accepted in sequential.items()})
+
+        # shards cover every flow once; with 4 shards, the first two and the last two are slabs along the first feature
+        shards = index_partition(samples, feature, 4)
+        self.assertEqual(sorted(f for shard in shards for f in shard), list(range(len(samples))))
+        first = [sum(feature.labeling.features[0].labeling.interval(samples[f][0])) for f in shards[0] + shards[1]]
+        last = [sum(feature.labeling.features[0].labeling.interval(samples[f][0])) for f in shards[2] + shards[3]]
+        self.assertLessEqual(max(first), min(last))
+
+    def test_vectorized_evaluation(self):
+        from ..common.evaluation import IncrementalSampleBasedEvaluator, value_array, prefix_sums
+
+        import copy
+        flows, feature = TestAnime.tuple_flows(30)
+        samples, _ = TestAnime.tuple_flows(60, seed=2)
+        # same flows with fractional cardinalities
+        label_info = copy.deepcopy(TestAnime.label_info)
+        label_info["s1"]["cost"] = label_info["u2"]["cost"] = 1.5
+        fractional = Feature('flow', TupleLabeling([Feature('src', HierarchicalLabeling(label_info)),
+                                                    Feature('proto', DValueLabeling(5)),
+                                                    Feature('dst', HierarchicalLabeling(label_info))]))
+
+        for feature in [feature, fractional]:
+            clustering = HierarchicalClusteringWithIndex(1)
+            clustering.cluster(flows, feature)
+
+            evaluator = IncrementalSampleBasedEvaluator(flows, samples, clustering.clusters, feature)
+            cover_maps = []
+            for g in [evaluator.p_cover_map_gen, evaluator.n_cover_map_gen]:
+                cover_maps.append(g.compute_cover_map(clustering.intents))
+                g.get_cover_map = lambda intent_info, args, cover_map=cover_maps[-1]: cover_map
+            res = evaluator.evaluate(clustering.intents, None)
+
+            cardinality = feature.labeling.cardinality
+            p_total = sum(cardinality(f) for f in flows)
+            n_total = sum(cardinality(f) for f in samples)
+            tp = fp = 0
+            for info in clustering.intents:
+                tp += sum(cardinality(flows[f]) for f in cover_maps[0][info.k])
+                fp += sum(cardinality(samples[f]) for f in cover_maps[1][info.k])
+                self.assertAlmostEqual(res[info.k]["tp"], tp)
+                self.assertAlmostEqual(res[info.k]["fp"], fp)
+                self.assertEqual(res[info.k]["tp"] + res[info.k]["fn"], p_total)
+                self.assertEqual(res[info.k]["fp"] + res[info.k]["tn"], n_total)
+            if feature is fractional:
+                self.assertNotEqual(p_total, int(p_total))
+
+        # sums that do not fit in int64 stay exact
+        self.assertEqual(prefix_sums(value_array([1 << 62, 1 << 62, 3]), [[0], [1, 2], []]),
+                         [1 << 62, (1 << 63) + 3, (1 << 63) + 3])
+
+    def test_cover_map_file(self):
+        import tempfile
+        from argparse import Namespace
+        from ..common.evaluation import IncrementalCoverMapGenerator
+
+        flows, feature = TestAnime.tuple_flows(30)
+        clustering = HierarchicalClusteringWithIndex(1)
+        clustering.cluster(flows, feature)
+        intents = list(clustering.intents)
+
+        with tempfile.TemporaryDirectory() as out:
+            args = Namespace(out=out)
+            computed = IncrementalCoverMapGenerator("positive", flows, clustering.clusters, feature).get_cover_map(intents, args)
+            loaded = IncrementalCoverMapGenerator("positive", flows, clustering.clusters, feature).load_cover_map(intents, args)
+            self.assertEqual({k: list(v) for k, v in loaded.items()}, computed)
+
+            # a cover map of other flows is not reused
+            other = IncrementalCoverMapGenerator("positive", flows[:-1], clustering.clusters, feature)
+            self.assertIsNone(other.load_cover_map(intents, args))
+
+            # nor one computed with another hierarchy: u1 is a server in this one
+            import copy
+            label_info = copy.deepcopy(TestAnime.label_info)
+            label_info["u1"]["parents"] = {"Server"}
+            hierarchy = HierarchicalLabeling(label_info)
+            self.assertTrue(hierarchy.subset("u1", "Server"))
+            self.assertFalse(feature.labeling.features[0].labeling.subset("u1", "Server"))
+            other_feature = Feature('flow', TupleLabeling([Feature('src', hierarchy), Feature('proto', DValueLabeling(5)),
+                                                           Feature('dst', HierarchicalLabeling(TestAnime.label_info))]))
+            other = IncrementalCoverMapGenerator("positive", flows, clustering.clusters, other_feature)
+            self.assertIsNone(other.load_cover_map(intents, args))
+
+    def test_flow_store(self):
+        from ..common.flows import path_store, read_path_lines, cpp_flow_store, read_cpp_flows, read_cpp_hierarchy
+
+        lines = ["10.0.0.2 u1 s1\n", "\n", "10.0.0.2 u2 s1\n", "10.0.0.3 u1 s1\n"]
+        flows = path_store(True).extend(read_path_lines(iter(lines), True))
+        self.assertEqual(list(flows), [(IPv4Prefix(l.split()[0]), HRegex(l.split()[1:])) for l in lines if l.strip()])
+        # labels are interned per column
+        self.assertEqual(len(flows.column_labels("dst ip")), 2)
+        self.assertIs(flows[0][0], flows[1][0])
+
+        label_info, names = read_cpp_hierarchy(["Any 3\n", "u1 1 Any\n", "s1 1 Any\n"])
+        self.assertEqual(label_info["s1"], {"cost": 1, "parents": ["Any"]})
+        prefixes = cpp_flow_store().extend(read_cpp_flows(["10.0.0.0/24 1 2 10.0.0.1/32", " 2 1\n"], names))
+        ranges = cpp_flow_store().extend(read_cpp_flows(["167772160 167772415 1 2\n", "167772161 167772161 2 1\n"],
+                                                        names, ranges=True))
+        self.assertEqual(list(prefixes), list(ranges))
+        self.assertEqual(prefixes[1], (IPv4Prefix("10.0.0.1/32"), "s1", "u1"))
+
+    def test_cluster_unorderable_labels(self):
+        feature = Feature('flow', TupleLabeling([Feature('path', HRegexLabeling(HierarchicalLabeling(TestAnime.label_info)))]))
+        flows = [(HRegex(p),) for p in [["u1", "s1"], ["u1", "s2"], ["u2", "s1"], ["u2", "s2"], ["s1", "u1"]]]
+        self.assertEqual(len(HierarchicalClustering(1).cluster(flows, feature)), 1)
+
+
 class Inference(object):
     def __init__(self, labeling):
         self.labeling = labeling